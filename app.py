@@ -1,35 +1,312 @@
 import argparse
-import os, json, time, uuid, re
+import os, json, time, uuid, re, csv, hashlib, sqlite3, threading, gzip, zlib, math, bisect, shutil, subprocess
+import multiprocessing, zipfile, atexit
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import wraps
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from datetime import datetime, date, timedelta, timezone
 from io import BytesIO
-from flask import Flask, render_template, request, redirect, url_for, flash, session, abort, send_from_directory, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, session, abort, send_from_directory, send_file, g, has_app_context
+from contextlib import contextmanager
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from flask_sqlalchemy.session import Session as FsaSession
+from sqlalchemy import func, insert, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.orm import Session as OrmSession, selectinload
 import msal
 from urllib.parse import urlencode
 from werkzeug.utils import secure_filename
-from openpyxl import Workbook
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.datastructures import CallbackDict
+from itsdangerous import Signer, BadSignature
+import requests
+from urllib3.exceptions import NewConnectionError
+import click
+from openpyxl import Workbook, load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+from preview_render import render_preview
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+try:
+    import brotli  # optional: pip install brotli
+except ImportError:
+    brotli = None
+try:
+    from PIL import Image  # optional: pip install Pillow (document previews)
+except ImportError:
+    Image = None
+try:
+    import fitz  # optional: pip install PyMuPDF (PDF previews; falls back to pdftoppm)
+except ImportError:
+    fitz = None
 
 app = Flask(__name__)
 
+# ---------------- Local data files ----------------
+# App Service (WEBSITE_SITE_NAME is set there) deploys the code to
+# /home/site/wwwroot; runtime files (sessions, tokens) go to /home/data
+# instead, elsewhere to Flask's instance folder. DATA_DIR overrides both.
+ON_APP_SERVICE = bool(os.environ.get("WEBSITE_SITE_NAME"))
+DATA_DIR = os.environ.get("DATA_DIR") or (os.path.join(os.environ.get("HOME", "/home"), "data")
+                                          if ON_APP_SERVICE else app.instance_path)
+# Opt-in (SQLITE_WAL=1): WAL needs shared memory between every process that
+# opens the file, so it is only safe when the database sits on a local disk.
+# Network filesystems - including the /home share of Azure App Service - don't
+# support it and can corrupt the database. WAL also sticks to the file once
+# set; switching back needs "PRAGMA journal_mode=DELETE" with the app stopped.
+SQLITE_WAL = os.environ.get("SQLITE_WAL", "0").strip().lower() in ("1", "true", "yes", "on")
+
+def sqlite_connect(path):
+    """Autocommit connection to one of the app's own SQLite files (rate limits, cache, sessions)."""
+    conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+    if SQLITE_WAL:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+# Number of reverse proxies in front of the app. Only that many
+# X-Forwarded-For/-Proto hops are trusted; remote_addr is then the real client
+# address (used for per-IP rate limits). Defaults to 1 on App Service, whose
+# front end always adds one hop; set it to 2 behind Front Door or App Gateway
+# as well, and leave it 0 when clients reach the app directly. Too low and
+# every client shares the proxy's rate-limit bucket; too high and clients can
+# spoof their address.
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "1" if ON_APP_SERVICE else "0"))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
+
 # --- Jinja filter: split (for environments that lack it) ---
 
 
+# ---------------- Health checks ----------------
+# /healthz (alias /livez) only says the process is serving requests; /readyz
+# adds the signals a load balancer or autoscaler should act on.
+HEALTH_DB_TTL = float(os.environ.get("HEALTH_DB_TTL", "5"))
+HEALTH_MIN_FREE_MB = int(os.environ.get("HEALTH_MIN_FREE_MB", "200"))
+HEALTH_PATHS = {"/healthz", "/livez", "/readyz"}
+HEALTH_QUEUES = {}  # name -> callable returning the number of items waiting to be written/sent
+_latencies = deque(maxlen=1000)  # seconds, most recent requests in this worker
+_db_probe = {"at": 0.0, "ok": None, "ms": None, "error": None}
+_db_probe_lock = threading.Lock()
+
+@app.before_request
+def _start_request_timer():
+    g._t0 = time.perf_counter()
+
+@app.after_request
+def _record_latency(resp):
+    t0 = g.get("_t0")
+    if t0 is not None and request.path not in HEALTH_PATHS:
+        _latencies.append(time.perf_counter() - t0)
+    return resp
+
+def latency_percentile(p):
+    samples = sorted(_latencies)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+def probe_db():
+    """SELECT 1 at most once per HEALTH_DB_TTL seconds; the error is reported by type only."""
+    with _db_probe_lock:
+        if time.time() - _db_probe["at"] < HEALTH_DB_TTL:
+            return dict(_db_probe)
+        t0 = time.perf_counter()
+        try:
+            db.session.execute(db.text("SELECT 1"))
+            _db_probe.update(ok=True, error=None)
+        except Exception as e:
+            app.logger.warning("readiness DB probe failed: %s", e)
+            db.session.rollback()
+            _db_probe.update(ok=False, error=type(e).__name__)
+        _db_probe.update(at=time.time(), ms=round((time.perf_counter() - t0) * 1000, 2))
+        return dict(_db_probe)
+
+def pool_stats():
+    pool = db.engine.pool
+    stats = {"class": type(pool).__name__}
+    for name in ("size", "checkedout", "overflow", "checkedin"):
+        fn = getattr(pool, name, None)
+        if callable(fn):
+            stats[name] = fn()
+    return stats
+
+@app.errorhandler(OperationalError)
+def _db_busy(e):
+    """SQLite lock timeouts become a retryable 503 instead of a bare 500."""
+    db.session.rollback()
+    if "locked" not in str(e.orig).lower():
+        app.logger.exception("database error")
+        return {"ok": False, "error": "database error"}, 500
+    app.logger.warning("database busy on %s %s", request.method, request.path)
+    return {"ok": False, "error": "database busy"}, 503, {"Retry-After": "1"}
+
+def queue_depths():
+    """{name: depth}; a queue whose callable fails reports None instead of failing the probe."""
+    out = {}
+    for name, depth in HEALTH_QUEUES.items():
+        try:
+            out[name] = depth()
+        except Exception as e:
+            app.logger.warning("queue depth %s failed: %s", name, e)
+            out[name] = None
+    return out
+
 @app.get("/healthz")
+@app.get("/livez")
 def healthz():
-    try:
-        # quick DB check
-        db.session.execute(db.text("SELECT 1"))
-        return {"ok": True, "db": "up"}, 200
-    except Exception as e:
-        return {"ok": False, "error": str(e)}, 500
+    return {"ok": True}, 200
+
+@app.get("/readyz")
+def readyz():
+    dbp = probe_db()
+    disk = shutil.disk_usage(UPLOAD_ROOT)
+    free_mb = disk.free // (1024 * 1024)
+    p95 = latency_percentile(95)
+    checks = {
+        "db": {"ok": dbp["ok"], "ms": dbp["ms"], "error": dbp["error"],
+               "age_s": round(time.time() - dbp["at"], 1)},
+        "pool": pool_stats(),
+        "uploads_disk": {"ok": free_mb >= HEALTH_MIN_FREE_MB, "free_mb": free_mb,
+                         "used_pct": round(disk.used / disk.total * 100, 1)},
+        "queues": queue_depths(),
+        "latency": {"p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+                    "p50_ms": round(latency_percentile(50) * 1000, 1) if p95 is not None else None,
+                    "samples": len(_latencies)},
+    }
+    ok = bool(dbp["ok"]) and checks["uploads_disk"]["ok"]
+    return {"ok": ok, "checks": checks}, 200 if ok else 503
 
 
 
 
 from flask import request, jsonify
 
+# ---------------- Rate limiting ----------------
+# Per-route limits like "10/minute"; RATE_LIMITS='{"ask_ai": "30/minute"}' overrides by endpoint.
+RATE_LIMITS = json.loads(os.environ.get("RATE_LIMITS", "{}") or "{}")
+RATE_LIMIT_DB_PATH = os.environ.get("RATE_LIMIT_DB_PATH")  # optional sqlite file shared by workers
+_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+def _parse_limit(spec):
+    n, _, per = spec.partition("/")
+    return int(n), _PERIODS[per.strip().rstrip("s")]
+
+def _token_bucket(state, now, limit, period):
+    """state = (tokens, last_refill, unused); bursts up to `limit`, refills limit/period per second."""
+    tokens, last, _ = state or (limit, now, 0)
+    tokens = min(limit, tokens + (now - last) * limit / period)
+    if tokens >= 1:
+        return (tokens - 1, now, 0), True, 0
+    return (tokens, now, 0), False, (1 - tokens) * period / limit
+
+def _sliding_window(state, now, limit, period):
+    """state = (window_start, count, previous_count); previous window weighted by overlap."""
+    start, count, prev = state or (now - now % period, 0, 0)
+    if now - start >= 2 * period:
+        start, count, prev = now - now % period, 0, 0
+    elif now - start >= period:
+        start, count, prev = start + period, 0, count
+    weight = 1 - (now - start) / period
+    if prev * weight + count < limit:
+        return (start, count + 1, prev), True, 0
+    # earliest moment the weighted previous window has decayed enough to admit one more
+    retry = period - (now - start) if count >= limit else (prev * weight + count - limit + 1) * period / max(prev, 1)
+    return (start, count, prev), False, retry
+
+RATE_ALGORITHMS = {"token_bucket": _token_bucket, "sliding_window": _sliding_window}
+
+class MemoryRateStore:
+    def __init__(self):
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, fn):
+        with self._lock:
+            state, allowed, retry = fn(self._state.get(key), time.time())
+            self._state[key] = state
+            if len(self._state) > 50000:  # drop idle keys; they restart with a full allowance
+                cutoff = time.time() - 86400
+                self._state = {k: v for k, v in self._state.items() if v[0] >= cutoff or v[1] >= cutoff}
+            return allowed, retry
+
+class SqliteRateStore:
+    """Shared state for multi-worker setups; each hit is one BEGIN IMMEDIATE read-modify-write."""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute("CREATE TABLE IF NOT EXISTS rate (key TEXT PRIMARY KEY, a REAL, b REAL, c REAL)")
+
+    def _conn(self):
+        if getattr(self._local, "conn", None) is None:
+            self._local.conn = sqlite_connect(self.path)
+        return self._local.conn
+
+    def hit(self, key, fn):
+        c = self._conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            row = c.execute("SELECT a, b, c FROM rate WHERE key = ?", (key,)).fetchone()
+            state, allowed, retry = fn(tuple(row) if row else None, time.time())
+            c.execute("INSERT OR REPLACE INTO rate (key, a, b, c) VALUES (?, ?, ?, ?)", (key, *state))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        return allowed, retry
+
+rate_store = SqliteRateStore(RATE_LIMIT_DB_PATH) if RATE_LIMIT_DB_PATH else MemoryRateStore()
+
+def _rate_key():
+    user = session.get("user") or {}
+    who = user.get("preferred_username") or user.get("oid")
+    return f"user:{who}" if who else f"ip:{request.remote_addr}"  # X-Forwarded-For is applied by ProxyFix only
+
+def rate_limit(default, algorithm="token_bucket"):
+    """Limit a view per user (or client IP) to `default`, e.g. "10/minute"; 429 + Retry-After when exceeded."""
+    step = RATE_ALGORITHMS[algorithm]
+    def deco(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            limit, period = _parse_limit(RATE_LIMITS.get(request.endpoint, default))
+            key = f"{request.endpoint}|{_rate_key()}"
+            try:
+                allowed, retry = rate_store.hit(key, lambda st, now: step(st, now, limit, period))
+            except sqlite3.Error as e:  # fail open: the limiter must not take the route down
+                print("rate limiter error:", e)
+                allowed, retry = True, 0
+            if not allowed:
+                resp = jsonify({"ok": False, "error": "Too many requests, slow down.",
+                                "retry_after": int(retry) + 1})
+                resp.status_code = 429
+                resp.headers["Retry-After"] = str(int(retry) + 1)
+                return resp
+            return view(*args, **kwargs)
+        return wrapper
+    return deco
+
+def mymobileapi_send(messages, test_mode=False):
+    """POST a batch of {"destination", "content"[, "customerId"]} messages to MyMobileAPI BulkMessages."""
+    import base64
+    auth_raw = f"{MYMOBILEAPI_USERNAME}:{MYMOBILEAPI_PASSWORD}".encode("utf-8")
+    headers = {
+        "Authorization": "Basic " + base64.b64encode(auth_raw).decode("ascii"),
+        "accept": "application/json",
+        "content-type": "application/json",
+    }
+    payload = {"sendOptions": {"testMode": test_mode}, "messages": messages}
+    return requests.post(MYMOBILEAPI_URL, json=payload, headers=headers, timeout=15)
+
 @app.route("/sms/send", methods=["POST"])
+@rate_limit("5/minute")
 def sms_send():
     """Send an SMS via MyMobileAPI BulkMessages.
     Expected JSON: {"destination": "+27...", "message": "text", "testMode": false}
@@ -44,27 +321,9 @@ def sms_send():
         if not dest or not msg:
             return jsonify({"ok": False, "error": "Missing destination or message"}), 400
 
-        # Build Basic auth header
-        import base64, requests
-        auth_raw = f"{MYMOBILEAPI_USERNAME}:{MYMOBILEAPI_PASSWORD}".encode("utf-8")
-        auth_hdr = "Basic " + base64.b64encode(auth_raw).decode("ascii")
-
-        payload = {
-            "sendOptions": {"testMode": test_mode},
-            "messages": [
-                {"destination": dest, "content": msg}
-            ]
-        }
-
-        headers = {
-            "Authorization": auth_hdr,
-            "accept": "application/json",
-            "content-type": "application/json",
-        }
-
         # Post to MyMobileAPI
         try:
-            resp = requests.post(MYMOBILEAPI_URL, json=payload, headers=headers, timeout=15)
+            resp = mymobileapi_send([{"destination": dest, "content": msg}], test_mode=test_mode)
             try:
                 body = resp.json()
             except Exception:
@@ -92,18 +351,16 @@ def jinja_split(value, sep="|"):
 # =========================
 # Provider rename map (canonicalization)
 # =========================
+# Seeds ProviderAlias on first run; the DB table is authoritative afterwards.
 RENAME_MAP = {
     "Umvuzo Fedhealth": "Intelligene Fedhealth",
     "Umvuzo Intelligene": "Intelligene Umvuzo",  # legacy
 }
-REVERSE_MAP = {}
-for _old, _new in RENAME_MAP.items():
-    REVERSE_MAP.setdefault(_new, set()).add(_old)
 
 def normalize_provider(name: str | None) -> str | None:
     if not name:
         return name
-    return RENAME_MAP.get(name, name)
+    return resolve_provider(name)[1]
 
 # --- Demo timer sample (not used by main orders view) ---
 orders_demo = [
@@ -159,6 +416,12 @@ def time_left(obj):
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-key-change-me")
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///life360.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Optional read replica (Postgres streaming replica, or a second SQLite file kept
+# current with `flask sync-replica` for local testing).
+READ_REPLICA_URL = os.environ.get("READ_REPLICA_URL")
+READ_YOUR_WRITES_SECONDS = int(os.environ.get("READ_YOUR_WRITES_SECONDS", "10"))
+if READ_REPLICA_URL:
+    app.config["SQLALCHEMY_BINDS"] = {"replica": READ_REPLICA_URL}
 
 # Uploads
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -174,15 +437,104 @@ AUTHORITY = os.environ.get("AZURE_AUTHORITY", f"https://login.microsoftonline.co
 REDIRECT_PATH = os.environ.get("AZURE_REDIRECT_PATH", "/getAToken")
 SCOPE = os.environ.get("AZURE_SCOPE", "User.Read")
 
-db = SQLAlchemy(app)
+# ---------------- Read/write routing ----------------
+class RoutingSession(FsaSession):
+    """Sends plain SELECTs to the replica while the current request/job opted in.
 
-# Canonical provider list (in use)
+    Flushes, DML, SELECT ... FOR UPDATE, raw connection() use and everything
+    after the session's first write go to the primary, so a request always
+    reads its own writes.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kw):
+        if bind is None and READ_REPLICA_URL and has_app_context() and g.get("_db_route") == "replica":
+            if (not self._flushing and not self.info.get("wrote") and clause is not None
+                    and getattr(clause, "is_select", False) and getattr(clause, "_for_update_arg", None) is None):
+                return self._db.engines["replica"]
+            if self._flushing or clause is None or not getattr(clause, "is_select", False):
+                self.info["wrote"] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kw)
+
+db = SQLAlchemy(app, session_options={"class_": RoutingSession})
+
+@event.listens_for(Engine, "connect")
+def _sqlite_pragmas(dbapi_conn, record):
+    """With SQLITE_WAL, readers (reports, online backups) run without blocking writers."""
+    if SQLITE_WAL and isinstance(dbapi_conn, sqlite3.Connection):
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.close()
+
+def read_replica(view):
+    """Mark a read-only view as safe to serve from the replica."""
+    view._read_replica = True
+    return view
+
+@contextmanager
+def db_route(target):
+    """Route this app context's reads to "replica" or "primary" (for jobs and write-on-read helpers)."""
+    prev = g.get("_db_route")
+    g._db_route = target
+    try:
+        yield
+    finally:
+        g._db_route = prev
+
+@app.before_request
+def _choose_db_route():
+    """GET/HEAD on @read_replica views use the replica unless the client wrote recently."""
+    view = app.view_functions.get(request.endpoint)
+    pinned = request.cookies.get("pin_primary", type=float) or 0
+    if (READ_REPLICA_URL and request.method in ("GET", "HEAD") and getattr(view, "_read_replica", False)
+            and pinned < time.time()):
+        g._db_route = "replica"
+
+@app.after_request
+def _pin_writers_to_primary(resp):
+    if READ_REPLICA_URL and request.method not in ("GET", "HEAD", "OPTIONS"):
+        resp.set_cookie("pin_primary", str(int(time.time()) + READ_YOUR_WRITES_SECONDS),
+                        max_age=READ_YOUR_WRITES_SECONDS, httponly=True, samesite="Lax")
+    return resp
+
+@app.cli.command("sync-replica")
+def sync_replica_command():
+    """Copy the primary SQLite database onto the replica file (local testing only)."""
+    if not READ_REPLICA_URL:
+        raise click.ClickException("READ_REPLICA_URL is not set.")
+    primary, replica = db.engine.url, db.engines["replica"].url
+    if primary.get_backend_name() != "sqlite" or replica.get_backend_name() != "sqlite":
+        raise click.ClickException("sync-replica only copies SQLite files; use real replication for Postgres.")
+    src, dst = sqlite3.connect(primary.database), sqlite3.connect(replica.database)
+    with dst:
+        src.backup(dst)
+    src.close(); dst.close()
+    click.echo(f"Copied {primary.database} -> {replica.database}")
+
+# Canonical provider list (seeds the Provider table; use provider_names() at runtime)
 PROVIDERS = [
-    "Geneway", "Optiway", "Enbiosis", "Intelligene", "Healthy Me",
+    "Geneway", "Optiway", "Enbiosis", "Reboot", "Intelligene", "Healthy Me",
     "Intelligene Fedhealth", "Geko",
 ]
 
 # ---------------- Models ----------------
+class Provider(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), unique=True, nullable=False)
+    sort_order = db.Column(db.Integer, nullable=False, default=0)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+
+class ProviderAlias(db.Model):
+    """Any spelling that should resolve to a provider, including its own name."""
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(120), unique=True, nullable=False)  # lower(trim(alias))
+    alias = db.Column(db.String(120), nullable=False)
+    provider_id = db.Column(db.Integer, db.ForeignKey("provider.id"), nullable=False, index=True)
+
+def _row_version():
+    """Counter bumped by every UPDATE, ORM or bulk; feeds the API ETags."""
+    return db.Column(db.Integer, nullable=True, default=1, server_default="1",
+                     onupdate=func.coalesce(db.literal_column("row_version"), 0) + 1)
+
 class StockItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
@@ -194,6 +546,10 @@ class StockItem(db.Model):
     request_datetime = db.Column(db.DateTime, nullable=True)
     current_stock = db.Column(db.Integer, nullable=False, default=0)
     provider = db.Column(db.String(120), nullable=True)
+    provider_id = db.Column(db.Integer, db.ForeignKey("provider.id"), nullable=True, index=True)
+    sku = db.Column(db.String(120), nullable=True, index=True)  # matches OrderItem.sku; falls back to name
+    row_version = _row_version()
+    __table_args__ = (db.Index("ix_stock_item_expiry", "expiry_date"),)
 
 class StockUnit(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -203,6 +559,8 @@ class StockUnit(db.Model):
     item_id = db.Column(db.Integer, db.ForeignKey('stock_item.id'), nullable=False)
     item = db.relationship("StockItem", backref=db.backref("units", lazy="dynamic"))
     last_update = db.Column(db.DateTime, default=datetime.utcnow)
+    row_version = _row_version()
+    __table_args__ = (db.Index("ix_stock_unit_item_status_batch", "item_id", "status", "batch_number"),)
 
 class OrderUnit(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -210,12 +568,38 @@ class OrderUnit(db.Model):
     unit_id = db.Column(db.Integer, db.ForeignKey('stock_unit.id'), nullable=False)
     unit = db.relationship("StockUnit")
     assigned_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = ({"sqlite_autoincrement": True},)
+
+class StockMovement(db.Model):
+    """Append-only ledger of unit-level stock changes (never updated or deleted)."""
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, nullable=False)
+    unit_id = db.Column(db.Integer, nullable=True)  # unit row may be deleted later
+    barcode = db.Column(db.String(120), nullable=True)
+    kind = db.Column(db.String(20), nullable=False)  # add, assign, unassign, delete
+    order_id = db.Column(db.Integer, nullable=True)
+    d_total = db.Column(db.Integer, nullable=False, default=0)
+    d_in_stock = db.Column(db.Integer, nullable=False, default=0)
+    at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    __table_args__ = (db.Index("ix_stock_movement_item_at", "item_id", "at"),
+                      db.Index("ix_stock_movement_at", "at"))
+
+class StockSnapshot(db.Model):
+    """Compacted per-item levels covering every movement with id <= movement_id."""
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, nullable=False)
+    movement_id = db.Column(db.Integer, nullable=False, default=0)
+    as_of = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    in_stock = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index("ix_stock_snapshot_as_of", "as_of", "movement_id"),)
 
 
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     provider = db.Column(db.String(120), nullable=True)
+    provider_id = db.Column(db.Integer, db.ForeignKey("provider.id"), nullable=True, index=True)
     name = db.Column(db.String(120), nullable=True)
     surname = db.Column(db.String(120), nullable=True)
     practitioner_name = db.Column(db.String(120), nullable=True)
@@ -229,8 +613,11 @@ class Order(db.Model):
     results_sent = db.Column(db.Boolean, default=False)
     paid = db.Column(db.Boolean, default=False)
     invoiced = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    completed_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    completed_at = db.Column(db.DateTime, nullable=True, index=True)
+    row_version = _row_version()
+    __table_args__ = (db.Index("ix_order_open_created", "completed_at", "created_at"),
+                      {"sqlite_autoincrement": True})  # ids of archived orders must never be reused
 
     items = db.relationship("OrderItem", backref="order", cascade="all, delete-orphan", lazy=True)
 
@@ -239,22 +626,32 @@ class OrderItem(db.Model):
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
     sku = db.Column(db.String(120), nullable=False)
     qty = db.Column(db.Integer, nullable=False, default=1)
+    row_version = _row_version()
+    __table_args__ = ({"sqlite_autoincrement": True},)
+
 class Task(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     provider = db.Column(db.String(120), nullable=True)
+    provider_id = db.Column(db.Integer, db.ForeignKey("provider.id"), nullable=True, index=True)
     assignee = db.Column(db.String(120), nullable=True)
     due_date = db.Column(db.Date, nullable=True)
     status = db.Column(db.String(40), nullable=False, default="Open")  # Open, In Progress, Done
     notes = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    row_version = _row_version()
+    __table_args__ = (db.Index("ix_task_status_due", "status", "due_date"),
+                      db.Index("ix_task_assignee_status_due", "assignee", "status", "due_date"),
+                      db.Index("ix_task_provider_status_due", "provider", "status", "due_date"))
 
 class Document(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     provider = db.Column(db.String(120), nullable=False)
+    provider_id = db.Column(db.Integer, db.ForeignKey("provider.id"), nullable=True, index=True)
     filename = db.Column(db.String(255), nullable=False)
     stored_name = db.Column(db.String(255), nullable=False)  # unique on disk
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    row_version = _row_version()
 
 class OrderCallLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -263,6 +660,580 @@ class OrderCallLog(db.Model):
     author = db.Column(db.String(120), nullable=True)
     summary = db.Column(db.Text, nullable=False)
     outcome = db.Column(db.String(60), nullable=True)
+    __table_args__ = (db.Index("ix_order_call_log_order_when", "order_id", "when", "id"),
+                      {"sqlite_autoincrement": True})
+
+def _archive_table(src, name, *extra):
+    """Plain copy of `src`'s columns (no FKs, no autoincrement) for rows moved out of the hot table."""
+    cols = [db.Column(c.name, c.type, primary_key=c.primary_key, autoincrement=False) for c in src.columns]
+    return db.Table(name, db.metadata, *cols, *extra)
+
+# Completed orders moved out by archive_completed_orders(); partitioned by completion year.
+order_archive = _archive_table(Order.__table__, "order_archive",
+                               db.Column("archive_year", db.Integer, nullable=True),
+                               db.Column("archived_at", db.DateTime, nullable=True),
+                               db.Index("ix_order_archive_year_completed", "archive_year", "completed_at"),
+                               db.Index("ix_order_archive_created", "created_at"))
+order_item_archive = _archive_table(OrderItem.__table__, "order_item_archive",
+                                    db.Index("ix_order_item_archive_order", "order_id"))
+order_unit_archive = _archive_table(OrderUnit.__table__, "order_unit_archive",
+                                    db.Index("ix_order_unit_archive_order", "order_id"),
+                                    db.Index("ix_order_unit_archive_unit", "unit_id"))
+order_call_log_archive = _archive_table(OrderCallLog.__table__, "order_call_log_archive",
+                                        db.Index("ix_order_call_log_archive_order", "order_id"))
+
+class ReportCache(db.Model):
+    """Computed aggregate for one closed time bucket (see report_series)."""
+    id = db.Column(db.Integer, primary_key=True)
+    metric = db.Column(db.String(40), nullable=False)
+    period = db.Column(db.String(10), nullable=False)  # day, week, month
+    provider = db.Column(db.String(120), nullable=False, default="*")
+    bucket = db.Column(db.String(10), nullable=False)  # YYYY-MM-DD start of bucket
+    payload = db.Column(db.Text, nullable=False)
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint("metric", "period", "provider", "bucket"),)
+
+class Notification(db.Model):
+    """Outbound message (outbox row); idempotency_key makes re-queuing the same batch a no-op."""
+    id = db.Column(db.Integer, primary_key=True)
+    idempotency_key = db.Column(db.String(64), nullable=False, unique=True)
+    channel = db.Column(db.String(20), nullable=False, default="sms")
+    recipient = db.Column(db.String(200), nullable=True)  # practitioner or provider the batch is for
+    destination = db.Column(db.String(40), nullable=True)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="pending")  # pending, sending, sent, failed, no_destination
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    claimed_by = db.Column(db.String(32), nullable=True)
+    last_error = db.Column(db.String(200), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (db.Index("ix_notification_status", "status", "id"),)
+
+class SlaAlert(db.Model):
+    """One SLA breach (order + stage) that has been queued for notification."""
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False)
+    stage = db.Column(db.String(40), nullable=False)
+    notification_id = db.Column(db.Integer, db.ForeignKey("notification.id"), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint("order_id", "stage"),)
+
+class DataVersion(db.Model):
+    """Per-table write counter; part of every fragment cache key."""
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+def _ensure_sqlite_autoincrement():
+    """Keep SQLite from handing archived order/item/unit/call-log ids to new rows.
+
+    Tables created before archiving existed lack AUTOINCREMENT (SQLite then
+    reuses max(rowid)+1), so they are rebuilt once; sqlite_sequence is then
+    raised to the highest id seen in either the hot or the archive table.
+    """
+    if db.engine.url.get_backend_name() != "sqlite":
+        return  # Postgres sequences never go backwards
+    pairs = ((Order, order_archive), (OrderItem, order_item_archive),
+             (OrderUnit, order_unit_archive), (OrderCallLog, order_call_log_archive))
+    with db.engine.begin() as conn:
+        for model, archive in pairs:
+            t = model.__table__
+            sql = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type='table' AND name=?",
+                                       (t.name,)).scalar() or ""
+            if "AUTOINCREMENT" not in sql.upper():
+                have = {r[1] for r in conn.exec_driver_sql(f'PRAGMA table_info("{t.name}")')}
+                cols = ", ".join(f'"{c.name}"' for c in t.columns if c.name in have)
+                ddl = re.sub(rf'^\s*CREATE TABLE "?{t.name}"? ', f'CREATE TABLE "{t.name}__new" ',
+                             str(db.schema.CreateTable(t).compile(conn)), count=1)
+                conn.exec_driver_sql(ddl)
+                conn.exec_driver_sql(f'INSERT INTO "{t.name}__new" ({cols}) SELECT {cols} FROM "{t.name}"')
+                conn.exec_driver_sql(f'DROP TABLE "{t.name}"')  # its indexes go too; ensure_schema recreates them
+                conn.exec_driver_sql(f'ALTER TABLE "{t.name}__new" RENAME TO "{t.name}"')
+            top = max(conn.execute(db.select(func.max(t.c.id))).scalar() or 0,
+                      conn.execute(db.select(func.max(archive.c.id))).scalar() or 0)
+            seq = conn.exec_driver_sql("SELECT seq FROM sqlite_sequence WHERE name=?", (t.name,)).first()
+            if seq is None:
+                conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (t.name, top))
+            elif seq[0] < top:
+                conn.exec_driver_sql("UPDATE sqlite_sequence SET seq=? WHERE name=?", (top, t.name))
+
+def ensure_schema():
+    """create_all() plus columns and indexes declared on tables that already existed."""
+    db.create_all()
+    _ensure_sqlite_autoincrement()
+    insp = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        have = {c["name"] for c in insp.get_columns(table.name)}
+        for col in table.columns:
+            if col.name not in have and col.nullable:
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{col.name}" {col.type.compile(db.engine.dialect)}'
+                if col.server_default is not None:
+                    ddl += f" DEFAULT {col.server_default.arg}"
+                try:
+                    with db.engine.begin() as conn:
+                        conn.execute(db.text(ddl))
+                except OperationalError as e:
+                    if "duplicate column" not in str(e.orig).lower():  # another process added it first
+                        raise
+        for idx in table.indexes:
+            idx.create(bind=db.engine, checkfirst=True)
+    have = {r[0] for r in db.session.query(DataVersion.name)}
+    for name in VERSIONED_NAMES - have:
+        db.session.add(DataVersion(name=name, version=0))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+    if Provider.query.first() is None:
+        seed_providers()
+        migrate_providers_db()
+    if StockSnapshot.query.first() is None:
+        take_stock_snapshot()  # baseline for units that predate the ledger
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """Exclusive lock across processes on `path` (flock, or msvcrt on Windows).
+
+    Yields True once held; with blocking=False yields False right away if
+    another process holds it.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a+") as f:
+        f.seek(0)
+        try:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            else:
+                while True:
+                    try:  # LK_NBLCK fails at once; LK_LOCK gives up after ~10 s, so keep retrying
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            raise
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            if fcntl is None:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def _schema_file_lock():
+    """Serialize schema setup across worker processes (threads use _schema_lock)."""
+    return file_lock(os.path.join(app.instance_path, ".schema.lock"))
+
+@app.before_request
+def _ensure_schema_once():
+    global _schema_ready
+    if _schema_ready or request.path in HEALTH_PATHS:  # probes must not run (or wait on) migrations
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        with _schema_file_lock(), db_route("primary"):  # _choose_db_route already ran for this request
+            ensure_schema()
+        _schema_ready = True
+        barcode_index.rebuild_async()
+        if SLA_REMINDERS:
+            _ensure_sla_scheduler()
+        if BACKUP_INTERVAL_HOURS > 0:
+            _ensure_backup_scheduler()
+
+# ---------------- Data versions + fragment cache ----------------
+UNVERSIONED_TABLES = {"data_version", "report_cache", "notification", "sla_alert"}
+VERSIONED_NAMES = {t.name for t in db.metadata.sorted_tables} - UNVERSIONED_TABLES | {"practitioners"}
+FRAGMENT_CACHE_MB = float(os.environ.get("FRAGMENT_CACHE_MB", "32"))
+FRAGMENT_CACHE_PATH = os.environ.get("FRAGMENT_CACHE_PATH")  # optional sqlite file shared by workers
+
+def _bump_versions(conn, names):
+    names = set(names) - UNVERSIONED_TABLES
+    if names:
+        conn.execute(db.update(DataVersion).where(DataVersion.name.in_(names))
+                     .values(version=DataVersion.version + 1))
+
+@event.listens_for(OrmSession, "after_flush")
+def _bump_on_flush(sess, flush_context):
+    touched = {o.__table__.name for o in list(sess.new) + list(sess.deleted)}
+    touched |= {o.__table__.name for o in sess.dirty if sess.is_modified(o)}
+    _bump_versions(sess.connection(), touched)
+
+@event.listens_for(OrmSession, "do_orm_execute")
+def _bump_on_bulk(state):
+    if (state.is_update or state.is_delete or state.is_insert) and state.bind_mapper is not None:
+        _bump_versions(state.session.connection(), [state.bind_mapper.local_table.name])
+
+def bump_data_version(*names):
+    """Manually invalidate state that does not live in a mapped table (e.g. PRACTITIONERS)."""
+    _bump_versions(db.session.connection(), names)
+    db.session.commit()
+
+def data_versions():
+    """{name: version}, read once per request."""
+    if "data_versions" not in g:
+        g.data_versions = dict(db.session.query(DataVersion.name, DataVersion.version))
+    return g.data_versions
+
+class SqliteCacheBackend:
+    """Size-capped key/value store in a local SQLite file, shared across worker processes."""
+    def __init__(self, path, max_bytes):
+        self.path, self.max_bytes = path, max_bytes
+        self._local = threading.local()
+        with self._conn() as c:
+            c.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, atime REAL)")
+            c.execute("CREATE INDEX IF NOT EXISTS ix_cache_atime ON cache (atime)")
+
+    def _conn(self):
+        if getattr(self._local, "conn", None) is None:
+            self._local.conn = sqlite_connect(self.path)
+        return self._local.conn
+
+    def get(self, key):
+        row = self._conn().execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._conn().execute("UPDATE cache SET atime = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def set(self, key, value):
+        c = self._conn()
+        c.execute("INSERT OR REPLACE INTO cache (key, value, size, atime) VALUES (?, ?, ?, ?)",
+                  (key, value, len(value), time.time()))
+        total = c.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total > self.max_bytes:
+            # drop the least recently used quarter of the budget in one statement
+            c.execute("""DELETE FROM cache WHERE key IN (
+                SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY atime) AS running FROM cache)
+                WHERE running <= ?)""", (total - self.max_bytes * 0.75,))
+
+class FragmentCache:
+    """In-process LRU bounded by total bytes, optionally backed by a shared store."""
+    def __init__(self, max_bytes, backend=None):
+        self.max_bytes, self.backend = max_bytes, backend
+        self._data = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+        value = None
+        if self.backend is not None:
+            try:
+                value = self.backend.get(key)
+            except sqlite3.Error:
+                value = None
+            if value is not None:
+                self._put(key, value)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._put(key, value)
+        if self.backend is not None:
+            try:
+                self.backend.set(key, value)
+            except sqlite3.Error as e:
+                print("fragment cache backend error:", e)
+
+    def _put(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._size -= len(self._data.pop(key))
+            self._data[key] = value
+            self._size += size
+            while self._size > self.max_bytes:
+                _, old = self._data.popitem(last=False)
+                self._size -= len(old)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self._size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "shared": self.backend is not None}
+
+fragment_cache = FragmentCache(
+    int(FRAGMENT_CACHE_MB * 1024 * 1024),
+    SqliteCacheBackend(FRAGMENT_CACHE_PATH, int(FRAGMENT_CACHE_MB * 4 * 1024 * 1024)) if FRAGMENT_CACHE_PATH else None,
+)
+
+def cached_fragment(section, tables, build, *key_parts):
+    """Return build() (a str), cached under section + key_parts + versions of `tables`.
+
+    A build() returning None is passed through and not cached.
+    """
+    versions = data_versions()
+    raw = "|".join([section, *map(str, key_parts), *(f"{t}={versions.get(t, 0)}" for t in sorted(tables))])
+    key = hashlib.sha1(raw.encode()).hexdigest()
+    hit = fragment_cache.get(key)
+    if hit is not None:
+        return hit.decode("utf-8") if isinstance(hit, bytes) else hit
+    value = build()
+    if value is not None:
+        fragment_cache.set(key, value.encode("utf-8"))
+    return value
+
+def cached_page(section, tables, max_age=None):
+    """Cache a GET view's rendered HTML until one of `tables` is written.
+
+    Pages that also depend on the clock pass max_age (seconds): the key then
+    includes the current max_age-sized time bucket. Skipped while flash
+    messages are pending so they are never frozen into a cached page.
+    """
+    def deco(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET" or session.get("_flashes"):
+                return view(*args, **kwargs)
+            user = (session.get("user") or {}).get("preferred_username", "")
+            built = []
+            def build():
+                rv = view(*args, **kwargs)
+                built.append(rv)
+                return rv if isinstance(rv, str) else None
+            bucket = int(time.time() // max_age) if max_age else ""
+            html = cached_fragment(f"page:{section}", tables, build, request.full_path, user, bucket)
+            return built[0] if html is None else html  # redirects/errors pass through uncached
+        return wrapper
+    return deco
+
+# ---------------- Provider registry ----------------
+PROVIDER_MODELS = (StockItem, Order, Task, Document)
+PROVIDER_CACHE_CHECK_SECONDS = 5
+_provider_cache = {"checked": 0.0, "versions": None, "index": {}, "names": [], "aliases": {}}
+_provider_cache_lock = threading.Lock()
+
+def _provider_index():
+    """alias key -> (provider_id, canonical name), reloaded only when the tables' data versions move."""
+    c = _provider_cache
+    if not has_app_context():
+        return c["index"]
+    now = time.time()
+    if now - c["checked"] < PROVIDER_CACHE_CHECK_SECONDS:
+        return c["index"]
+    with _provider_cache_lock, db.session.no_autoflush:
+        try:
+            versions = tuple(db.session.query(DataVersion.version)
+                             .filter(DataVersion.name.in_(["provider", "provider_alias"]))
+                             .order_by(DataVersion.name))
+            if versions != c["versions"]:
+                providers = Provider.query.order_by(Provider.sort_order, Provider.name).all()
+                by_id = {p.id: p.name for p in providers}
+                index, aliases = {}, {}
+                for a in ProviderAlias.query:
+                    if a.provider_id in by_id:
+                        index[a.key] = (a.provider_id, by_id[a.provider_id])
+                        aliases.setdefault(by_id[a.provider_id], []).append(a.alias)
+                c.update(index=index, aliases=aliases, versions=versions,
+                         names=[p.name for p in providers if p.active])
+            c["checked"] = now
+        except Exception as e:  # tables not created yet: fall back to RENAME_MAP
+            print("provider cache load error:", e)
+    return c["index"]
+
+def resolve_provider(name):
+    """(provider_id, canonical name) for any known spelling; (None, name) for unknown ones."""
+    hit = _provider_index().get(name.strip().lower())
+    if hit:
+        return hit
+    return None, RENAME_MAP.get(name, name)
+
+def provider_names():
+    _provider_index()
+    return list(_provider_cache["names"]) or list(PROVIDERS)
+
+def provider_aliases(name):
+    _provider_index()
+    return list(_provider_cache["aliases"].get(name, []))
+
+@event.listens_for(OrmSession, "before_flush")
+def _canonicalize_providers(sess, flush_context, instances):
+    for obj in list(sess.new) + list(sess.dirty):
+        if isinstance(obj, PROVIDER_MODELS) and obj.provider:
+            pid, canonical = resolve_provider(obj.provider)
+            if obj.provider != canonical:
+                obj.provider = canonical
+            if obj.provider_id != pid:
+                obj.provider_id = pid
+
+def seed_providers():
+    for i, name in enumerate(PROVIDERS):
+        db.session.add(Provider(name=name, sort_order=i))
+    db.session.flush()
+    for old, new in RENAME_MAP.items():
+        if not Provider.query.filter_by(name=new).first():
+            db.session.add(Provider(name=new, sort_order=len(PROVIDERS), active=False))
+    db.session.flush()
+    for p in Provider.query:
+        db.session.add(ProviderAlias(key=p.name.lower(), alias=p.name, provider_id=p.id))
+    for old, new in RENAME_MAP.items():
+        target = Provider.query.filter_by(name=new).one()
+        db.session.add(ProviderAlias(key=old.lower(), alias=old, provider_id=target.id))
+    db.session.commit()
+    _provider_cache["checked"] = 0.0
+
+def migrate_providers_db():
+    """Set-based provider canonicalization: two UPDATEs per table, whatever the number of aliases."""
+    _provider_cache["checked"] = 0.0
+    for t in [m.__table__ for m in PROVIDER_MODELS] + [order_archive]:
+        alias_id = (db.select(ProviderAlias.provider_id)
+                    .where(ProviderAlias.key == func.lower(func.trim(t.c.provider))).scalar_subquery())
+        db.session.execute(db.update(t).values(provider_id=alias_id).where(
+            t.c.provider != None, db.exists(alias_id.element),
+            db.or_(t.c.provider_id == None, t.c.provider_id != alias_id)))
+        canonical = db.select(Provider.name).where(Provider.id == t.c.provider_id).scalar_subquery()
+        db.session.execute(db.update(t).values(provider=canonical).where(
+            t.c.provider_id != None, t.c.provider != canonical))
+    _bump_versions(db.session.connection(), [m.__table__.name for m in PROVIDER_MODELS] + ["order_archive"])
+    db.session.commit()
+
+def rename_provider(old, new):
+    """Point `old` (and everything filed under it) at provider `new`, creating it if needed."""
+    target = Provider.query.filter_by(name=new).first()
+    if target is None:
+        target = Provider(name=new, sort_order=Provider.query.count())
+        db.session.add(target); db.session.flush()
+        db.session.add(ProviderAlias(key=new.lower(), alias=new, provider_id=target.id))
+    alias = ProviderAlias.query.filter_by(key=old.strip().lower()).first()
+    if alias is None:
+        db.session.add(ProviderAlias(key=old.strip().lower(), alias=old, provider_id=target.id))
+    else:
+        alias.provider_id = target.id
+    old_provider = Provider.query.filter_by(name=old).first()
+    if old_provider is not None and old_provider.id != target.id:
+        old_provider.active = False
+        ProviderAlias.query.filter_by(provider_id=old_provider.id).update({"provider_id": target.id})
+    db.session.commit()
+    migrate_providers_db()
+    invalidate_report_cache()  # cached payloads are keyed by provider name
+
+@app.cli.command("rename-provider")
+@click.argument("old")
+@click.argument("new")
+def rename_provider_command(old, new):
+    """Alias provider OLD to NEW and rewrite every stored row in one pass."""
+    ensure_schema()
+    rename_provider(old, new)
+    click.echo(f"{old} -> {new}")
+
+# ---------------- Response compression + static assets ----------------
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", "6"))
+COMPRESS_MIMETYPES = {"text/html", "application/json", "text/csv", "text/css", "text/plain",
+                      "application/javascript", "text/javascript", "image/svg+xml"}
+ASSET_DIRS = [app.static_folder, os.path.join(BASE_DIR, "src")]
+ASSET_MAX_AGE = 365 * 24 * 3600
+_asset_hashes = {}  # path -> (mtime, hash)
+
+def _pick_encoding():
+    accept = request.accept_encodings
+    if brotli is not None and accept["br"]:
+        return "br"
+    if accept["gzip"]:
+        return "gzip"
+    return None
+
+def _stream_compress(chunks, encoding):
+    if encoding == "br":
+        comp = brotli.Compressor(quality=5)
+        for chunk in chunks:
+            out = comp.process(chunk) + comp.flush()
+            if out:
+                yield out
+        yield comp.finish()
+    else:
+        comp = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+        for chunk in chunks:
+            out = comp.compress(chunk) + comp.flush(zlib.Z_SYNC_FLUSH)
+            if out:
+                yield out
+        yield comp.flush()
+
+@app.after_request
+def compress_response(resp):
+    """gzip/brotli for text-like responses; streamed bodies are compressed chunk by chunk."""
+    if (resp.status_code != 200 or resp.mimetype not in COMPRESS_MIMETYPES
+            or "Content-Encoding" in resp.headers or request.method == "HEAD"):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    encoding = _pick_encoding()
+    if encoding is None:
+        return resp
+    if resp.is_streamed or resp.direct_passthrough:
+        body = resp.response
+        resp.direct_passthrough = False
+        resp.response = _stream_compress((c.encode(resp.charset) if isinstance(c, str) else c for c in body), encoding)
+        resp.headers.pop("Content-Length", None)
+        resp.call_on_close(getattr(body, "close", lambda: None))
+    else:
+        data = resp.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return resp
+        if encoding == "br":
+            resp.set_data(brotli.compress(data, quality=5))
+        else:
+            resp.set_data(gzip.compress(data, COMPRESS_LEVEL, mtime=0))
+    resp.headers["Content-Encoding"] = encoding
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+def _find_asset(filename):
+    for d in ASSET_DIRS:
+        if d and os.path.isfile(os.path.join(d, filename)):
+            return d
+    return None
+
+def _asset_hash(path):
+    mtime = os.path.getmtime(path)
+    cached = _asset_hashes.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, "rb") as fh:
+        digest = hashlib.sha256(fh.read()).hexdigest()[:12]
+    _asset_hashes[path] = (mtime, digest)
+    return digest
+
+@app.template_global()
+def asset_url(filename):
+    """Content-hashed URL for a static asset, e.g. styles.css -> /assets/styles.1a2b3c4d5e6f.css."""
+    d = _find_asset(filename)
+    if d is None:
+        return url_for("static", filename=filename)
+    stem, dot, ext = filename.rpartition(".")
+    digest = _asset_hash(os.path.join(d, filename))
+    return url_for("fingerprinted_asset", filename=f"{stem}.{digest}.{ext}" if dot else f"{filename}.{digest}")
+
+@app.get("/assets/<path:filename>")
+def fingerprinted_asset(filename):
+    m = re.fullmatch(r"(.+)\.([0-9a-f]{12})(\.[^./]+)?", filename)
+    if not m:
+        abort(404)
+    real = m.group(1) + (m.group(3) or "")
+    d = _find_asset(real)
+    if d is None:
+        abort(404)
+    resp = send_from_directory(d, real)
+    if _asset_hash(os.path.join(d, real)) == m.group(2):
+        resp.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    else:
+        resp.headers["Cache-Control"] = "no-cache"  # stale hash: don't pin old URLs to new content
+    return resp
 
 # ---------------- Dummy Data ----------------
 PRACTITIONERS = []
@@ -445,17 +1416,21 @@ def bucket_order(o):
 # ---------------- Dashboard ----------------
 
 @app.route("/")
+@read_replica
+@cached_page("dashboard", ("order", "order_item", "order_archive", "practitioners"))
 def dashboard():
     user = session.get("user")
-    seed_demo_if_empty()
-    migrate_orders_to_db()
+    with db_route("primary"):  # may write; must not decide from a lagging replica
+        seed_demo_if_empty()
+        migrate_orders_to_db()
     total_prac = len(PRACTITIONERS)
     onboarded = sum(1 for p in PRACTITIONERS if p["onboarded"])
     pending_prac = total_prac - onboarded
 
     # Orders from DB
-    total_orders = db.session.query(Order).count()
-    completed_orders = db.session.query(Order).filter(Order.status.ilike("%completed%")).count()
+    archived_orders = db.session.query(func.count()).select_from(order_archive).scalar()
+    total_orders = db.session.query(Order).count() + archived_orders
+    completed_orders = db.session.query(Order).filter(Order.status.ilike("%completed%")).count() + archived_orders
     cancelled_orders = db.session.query(Order).filter(Order.status.ilike("%cancel%")).count()
     pending_orders = total_orders - completed_orders - cancelled_orders
 
@@ -499,6 +1474,7 @@ def practitioners_update(pid):
             p["engagebay"] = 'engagebay' in request.form
             p["onboarded"] = 'onboarded' in request.form
             p["interests_list"] = listify_interests(p.get("interests"))
+            bump_data_version("practitioners")
             flash("Practitioner flags updated.", "success")
             break
     return redirect(url_for("practitioners"))
@@ -506,9 +1482,12 @@ def practitioners_update(pid):
 # ---------------- Orders + Call Logs ----------------
 
 @app.route("/orders", endpoint="orders")
+@read_replica
+@cached_page("orders", ("order", "order_item", "order_unit", "order_call_log", "stock_unit"), max_age=60)  # time_left()
 def orders_view():
-    seed_demo_if_empty()
-    migrate_orders_to_db()
+    with db_route("primary"):  # may write; must not decide from a lagging replica
+        seed_demo_if_empty()
+        migrate_orders_to_db()
 
     # Fetch all orders from DB, newest first
     db_orders = db.session.query(Order).order_by(Order.created_at.desc()).all()
@@ -530,23 +1509,460 @@ def orders_view():
     for ou in OrderUnit.query.all():
         assigned_units.setdefault(ou.order_id, []).append(ou)
 
+    order_ids = [o["id"] for o in orders]
+    call_logs_by_order = latest_call_logs(order_ids)
     return render_template("orders.html",
                            user=session.get("user"),
                            orders=orders,
                            assigned_units=assigned_units,
-                           call_logs=OrderCallLog.query.all())
+                           call_logs=[cl for logs in call_logs_by_order.values() for cl in logs],
+                           call_logs_by_order=call_logs_by_order,
+                           call_log_counts=call_log_counts(order_ids))
+
+# ---------------- Call logs ----------------
+CALL_LOG_PREVIEW = int(os.environ.get("CALL_LOG_PREVIEW", "3"))
+CALL_LOG_PAGE_SIZE = 20
+_IN_CHUNK = 500  # keep IN (...) lists under SQLite's bound-parameter limit
+
+def _chunks(ids, n=_IN_CHUNK):
+    ids = list(ids)
+    for i in range(0, len(ids), n):
+        yield ids[i:i + n]
+
+def latest_call_logs(order_ids, n=CALL_LOG_PREVIEW):
+    """{order_id: [newest n OrderCallLog rows]} in one windowed query per chunk of ids."""
+    out = {}
+    for chunk in _chunks(order_ids):
+        rn = func.row_number().over(partition_by=OrderCallLog.order_id,
+                                    order_by=(OrderCallLog.when.desc(), OrderCallLog.id.desc())).label("rn")
+        ranked = (db.session.query(OrderCallLog.id, rn)
+                  .filter(OrderCallLog.order_id.in_(chunk)).subquery())
+        rows = (OrderCallLog.query.join(ranked, ranked.c.id == OrderCallLog.id)
+                .filter(ranked.c.rn <= n)
+                .order_by(OrderCallLog.order_id, OrderCallLog.when.desc(), OrderCallLog.id.desc()))
+        for cl in rows:
+            out.setdefault(cl.order_id, []).append(cl)
+    return out
+
+def call_log_counts(order_ids):
+    """{order_id: number of call logs}, so the page can show "N older" links."""
+    out = {}
+    for chunk in _chunks(order_ids):
+        out.update(db.session.query(OrderCallLog.order_id, func.count(OrderCallLog.id))
+                   .filter(OrderCallLog.order_id.in_(chunk)).group_by(OrderCallLog.order_id))
+    return out
+
+def _call_log_json(r):
+    return {"id": r.id, "order_id": r.order_id, "when": _iso(r.when), "author": r.author,
+            "summary": r.summary, "outcome": r.outcome}
+
+@app.get("/orders/<int:order_id>/call_logs")
+@read_replica
+def order_call_logs(order_id):
+    """Newest-first timeline for one order (archived orders included).
+
+    Keyset-paginated on (when, id): pass the returned `before` value back to
+    get the next, older page.
+    """
+    limit = min(max(request.args.get("limit", CALL_LOG_PAGE_SIZE, type=int), 1), 200)
+    timeline = db.union_all(
+        db.select(OrderCallLog.__table__).where(OrderCallLog.order_id == order_id),
+        db.select(order_call_log_archive).where(order_call_log_archive.c.order_id == order_id),
+    ).subquery()
+    q = db.select(timeline)
+    if request.args.get("before"):
+        try:
+            when_s, _, id_s = request.args["before"].partition(",")
+            when, last_id = datetime.fromisoformat(when_s), int(id_s)
+        except ValueError:
+            return jsonify({"ok": False, "error": "bad before cursor"}), 400
+        q = q.where(db.or_(timeline.c.when < when, db.and_(timeline.c.when == when, timeline.c.id < last_id)))
+    rows = db.session.execute(q.order_by(timeline.c.when.desc(), timeline.c.id.desc()).limit(limit)).all()
+    nxt = f"{rows[-1].when.isoformat()},{rows[-1].id}" if len(rows) == limit else None
+    return jsonify({"ok": True, "order_id": order_id, "data": [_call_log_json(r) for r in rows], "before": nxt})
+
+# ---------------- Stock ledger + snapshots ----------------
+STOCK_SNAPSHOT_HOURS = int(os.environ.get("STOCK_SNAPSHOT_HOURS", "24"))
+
+def record_stock_movement(unit, kind, order_id=None):
+    """Append a ledger row for `unit` in the caller's transaction (unit must be flushed)."""
+    d_total, d_in_stock = {
+        "add": (1, 1),
+        "assign": (0, -1),
+        "unassign": (0, 1),
+        "delete": (-1, -1 if unit.status == "In Stock" else 0),
+    }[kind]
+    db.session.add(StockMovement(item_id=unit.item_id, unit_id=unit.id, barcode=unit.barcode, kind=kind,
+                                 order_id=order_id, d_total=d_total, d_in_stock=d_in_stock,
+                                 at=datetime.utcnow()))
+
+def stock_levels(at=None):
+    """{item_id: {"total", "in_stock"}} as of `at` (datetime, default now).
+
+    Starts from the newest snapshot generation at or before `at` and adds the
+    ledger rows written after it, so cost is bounded by the snapshot interval.
+    """
+    at = at or datetime.utcnow()
+    checkpoint = (db.session.query(func.max(StockSnapshot.movement_id))
+                  .filter(StockSnapshot.as_of <= at).scalar())
+    levels = {}
+    if checkpoint is not None:
+        for s in StockSnapshot.query.filter(StockSnapshot.movement_id == checkpoint, StockSnapshot.item_id != 0):
+            levels[s.item_id] = {"total": s.total, "in_stock": s.in_stock}
+    q = (db.session.query(StockMovement.item_id, func.sum(StockMovement.d_total), func.sum(StockMovement.d_in_stock))
+         .filter(StockMovement.id > (checkpoint or 0), StockMovement.at <= at)
+         .group_by(StockMovement.item_id))
+    for item_id, d_total, d_in_stock in q:
+        lv = levels.setdefault(item_id, {"total": 0, "in_stock": 0})
+        lv["total"] += int(d_total or 0)
+        lv["in_stock"] += int(d_in_stock or 0)
+    return levels
+
+def low_stock_items(threshold, limit=100):
+    """Items with at most `threshold` units in stock per the ledger, lowest first."""
+    levels = stock_levels()
+    items = [(levels.get(si.id, {}).get("in_stock", 0), si.id, si) for si in StockItem.query]
+    return [(si, qty) for qty, _, si in sorted(items, key=lambda e: e[:2]) if qty <= threshold][:limit]
+
+def take_stock_snapshot():
+    """Compact the ledger into a new snapshot generation for every item."""
+    checkpoint = db.session.query(func.max(StockMovement.id)).scalar() or 0
+    if StockSnapshot.query.first() is None:
+        # First run: seed from the units themselves (covers stock that predates the ledger).
+        levels = {}
+        q = (db.session.query(StockUnit.item_id, func.count(StockUnit.id),
+                              func.sum(db.case((StockUnit.status == "In Stock", 1), else_=0)))
+             .group_by(StockUnit.item_id))
+        for item_id, total, in_stock in q:
+            levels[item_id] = {"total": total, "in_stock": int(in_stock or 0)}
+    else:
+        levels = stock_levels()
+    now = datetime.utcnow()
+    for item_id, lv in levels.items():
+        db.session.add(StockSnapshot(item_id=item_id, movement_id=checkpoint, as_of=now, **lv))
+    if not levels:
+        db.session.add(StockSnapshot(item_id=0, movement_id=checkpoint, as_of=now))  # generation marker
+    db.session.commit()
+
+def maybe_snapshot_stock():
+    last = db.session.query(func.max(StockSnapshot.as_of)).scalar()
+    if last is None or datetime.utcnow() - last >= timedelta(hours=STOCK_SNAPSHOT_HOURS):
+        try:
+            take_stock_snapshot()
+        except Exception as e:
+            db.session.rollback()
+            print("take_stock_snapshot error:", e)
+
+@app.get("/stock/levels.json")
+@read_replica
+def stock_levels_json():
+    at = parse_dt(request.args.get("at"))
+    levels = stock_levels(at)
+    items = StockItem.query.order_by(StockItem.id).all()
+    return jsonify({"ok": True, "at": (at or datetime.utcnow()).isoformat(), "items": [
+        {"item_id": i.id, "name": i.name, "provider": normalize_provider(i.provider),
+         **levels.get(i.id, {"total": 0, "in_stock": 0})} for i in items]})
+
+# ---------------- Barcode index ----------------
+BARCODE_BLOOM_FP_RATE = 0.01
+BARCODE_SYNC_SECONDS = float(os.environ.get("BARCODE_SYNC_SECONDS", "2"))
+BARCODE_DELTA_MAX = 20000
+_MOVEMENT_STATUS = {"add": "In Stock", "unassign": "In Stock", "assign": "Assigned", "delete": None}
+
+def _barcode_hash(barcode):
+    """Two independent 64-bit hashes; the first doubles as the barcode's key in the index."""
+    d = hashlib.blake2b(barcode.encode("utf-8"), digest_size=16).digest()
+    return int.from_bytes(d[:8], "little"), int.from_bytes(d[8:], "little") | 1
+
+class BloomFilter:
+    def __init__(self, capacity, fp_rate=BARCODE_BLOOM_FP_RATE):
+        self.m = max(8, int(math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)))
+        self.k = max(1, int(round(self.m / capacity * math.log(2))))
+        self.capacity = capacity
+        self.bits = bytearray((self.m + 7) // 8)
+        self.count = 0
+
+    def add(self, h1, h2):
+        for i in range(self.k):
+            pos = (h1 + i * h2) % self.m
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, hashes):
+        h1, h2 = hashes
+        for i in range(self.k):
+            pos = (h1 + i * h2) % self.m
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+class BarcodeIndex:
+    """Process-wide barcode -> (unit_id, status) index.
+
+    A Bloom filter answers "definitely unknown" without touching anything
+    else; known keys live in two sorted uint64 arrays (barcode hash, packed
+    unit id + status) plus a small dict of recent changes that a background
+    thread merges back in when it grows. The arrays and change dicts are
+    published together as one immutable snapshot tuple, so a lookup never
+    sees half of a swap. Kept current by the session after_commit hook for
+    this process and by replaying StockMovement rows written by other
+    workers. Until the first build finishes, ready is False and callers go
+    to the database.
+    """
+    def __init__(self):
+        self.ready = False
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._statuses = ["In Stock", "Assigned"]
+        # (bloom, keys, vals, merging, delta); merging is the delta being folded
+        # into keys/vals by the compactor, delta takes new writes meanwhile.
+        # Both map hash -> packed value, or None for removed.
+        self._snapshot = (BloomFilter(10000), array("Q"), array("Q"), {}, {})
+        self._compacting = False
+        self.movement_cursor = 0
+        self._last_sync = 0.0
+        self.built_at = None
+
+    def _pack(self, unit_id, status):
+        if status not in self._statuses:
+            self._statuses.append(status)
+        return unit_id << 8 | self._statuses.index(status)
+
+    def _unpack(self, packed):
+        return packed >> 8, self._statuses[packed & 0xFF]
+
+    def build_from(self, rows, movement_cursor=0):
+        """Replace the contents with (barcode, unit_id, status) rows."""
+        entries, hashes = [], []
+        for barcode, unit_id, status in rows:
+            h1, h2 = _barcode_hash(barcode)
+            entries.append(h1 << 64 | self._pack(unit_id, status))
+            hashes.append((h1, h2))
+        entries.sort()
+        bloom = BloomFilter(max(2 * len(entries), 10000))
+        for h in hashes:
+            bloom.add(*h)
+        del hashes
+        keys = array("Q", (e >> 64 for e in entries))
+        vals = array("Q", (e & 0xFFFFFFFFFFFFFFFF for e in entries))
+        del entries
+        with self._lock:
+            self._snapshot = (bloom, keys, vals, {}, {})
+            self.movement_cursor = movement_cursor
+            self.built_at = datetime.utcnow()
+            self.ready = True
+
+    def rebuild(self):
+        """Stream every unit from the database (call inside an app context)."""
+        cursor = db.session.query(func.max(StockMovement.id)).scalar() or 0
+        rows = db.session.query(StockUnit.barcode, StockUnit.id, StockUnit.status).yield_per(20000)
+        self.build_from(rows, cursor)
+
+    def rebuild_async(self):
+        def run():
+            try:
+                with app.app_context():
+                    self.rebuild()
+                    db.session.remove()
+            except Exception as e:
+                print("barcode index build error:", e)
+        threading.Thread(target=run, name="barcode-index", daemon=True).start()
+
+    def lookup(self, barcode):
+        """(unit_id, status) or None. Negative answers never touch the database."""
+        bloom, keys, vals, merging, delta = self._snapshot
+        hashes = _barcode_hash(barcode)
+        if hashes not in bloom:
+            return None
+        h1 = hashes[0]
+        for changes in (delta, merging):
+            if h1 in changes:
+                v = changes[h1]
+                return None if v is None else self._unpack(v)
+        i = bisect.bisect_left(keys, h1)
+        if i < len(keys) and keys[i] == h1:
+            return self._unpack(vals[i])
+        return None
+
+    def set(self, barcode, unit_id, status):
+        h1, h2 = _barcode_hash(barcode)
+        with self._lock:
+            bloom, _, _, _, delta = self._snapshot
+            bloom.add(h1, h2)
+            delta[h1] = self._pack(unit_id, status)
+            self._maybe_compact()
+
+    def remove(self, barcode):
+        with self._lock:
+            self._snapshot[4][_barcode_hash(barcode)[0]] = None
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        """Called with _lock held; the merge itself runs on a background thread."""
+        bloom, keys, vals, merging, delta = self._snapshot
+        if bloom.count >= bloom.capacity:
+            if self.ready:
+                self.ready = False  # bloom saturated: rebuild from the DB with a larger filter
+                self.rebuild_async()
+            return
+        if len(delta) < BARCODE_DELTA_MAX or self._compacting:
+            return
+        self._compacting = True
+        self._snapshot = (bloom, keys, vals, delta, {})
+        threading.Thread(target=self._compact, args=(keys, vals, delta),
+                         name="barcode-compact", daemon=True).start()
+
+    def _compact(self, keys, vals, merging):
+        """Merge the frozen change dict into copies of the sorted arrays and swap them in."""
+        try:
+            new_keys, new_vals = array("Q"), array("Q")
+            changes = sorted(merging.items())
+            i, n = 0, len(keys)
+            for h1, v in changes:
+                j = bisect.bisect_left(keys, h1, i)
+                new_keys.extend(keys[i:j]); new_vals.extend(vals[i:j])
+                i = j + 1 if j < n and keys[j] == h1 else j
+                if v is not None:
+                    new_keys.append(h1); new_vals.append(v)
+            new_keys.extend(keys[i:]); new_vals.extend(vals[i:])
+            with self._lock:
+                bloom, _, _, current, delta = self._snapshot
+                if current is merging:  # not replaced by a rebuild meanwhile
+                    self._snapshot = (bloom, new_keys, new_vals, {}, delta)
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    def apply_movement(self, barcode, unit_id, kind):
+        status = _MOVEMENT_STATUS.get(kind)
+        if status is None:
+            self.remove(barcode)
+        else:
+            self.set(barcode, unit_id, status)
+
+    def sync(self, force=False):
+        """Replay ledger rows from other workers (at most every BARCODE_SYNC_SECONDS).
+
+        One thread replays at a time; others skip and answer from the index as it is.
+        """
+        if not self.ready or (not force and time.time() - self._last_sync < BARCODE_SYNC_SECONDS):
+            return
+        if not self._sync_lock.acquire(blocking=force):
+            return
+        try:
+            if not force and time.time() - self._last_sync < BARCODE_SYNC_SECONDS:
+                return
+            self._last_sync = time.time()
+            rows = (db.session.query(StockMovement.id, StockMovement.barcode, StockMovement.unit_id, StockMovement.kind)
+                    .filter(StockMovement.id > self.movement_cursor).order_by(StockMovement.id).limit(10000).all())
+            for mid, barcode, unit_id, kind in rows:
+                if barcode:
+                    self.apply_movement(barcode, unit_id, kind)
+                self.movement_cursor = mid
+        finally:
+            self._sync_lock.release()
+
+    def memory_bytes(self):
+        import sys
+        bloom, keys, vals, merging, delta = self._snapshot
+        return (len(bloom.bits) + keys.itemsize * len(keys) + vals.itemsize * len(vals)
+                + sys.getsizeof(merging) + sys.getsizeof(delta))
+
+    def stats(self):
+        bloom, keys, vals, merging, delta = self._snapshot
+        changes = {**merging, **delta}
+        return {"ready": self.ready, "barcodes": len(keys) + sum(1 for v in changes.values() if v is not None),
+                "delta": len(changes), "bloom_bits": bloom.m, "bloom_hashes": bloom.k,
+                "memory_bytes": self.memory_bytes(), "movement_cursor": self.movement_cursor,
+                "built_at": _iso(self.built_at)}
+
+barcode_index = BarcodeIndex()
+
+def lookup_barcode(barcode):
+    """(unit_id, status) or None, from the index when ready, otherwise from the DB."""
+    if barcode_index.ready:
+        barcode_index.sync()
+        return barcode_index.lookup(barcode)
+    row = db.session.query(StockUnit.id, StockUnit.status).filter_by(barcode=barcode).first()
+    return tuple(row) if row else None
+
+@event.listens_for(OrmSession, "after_flush")
+def _collect_barcode_changes(sess, flush_context):
+    changes = sess.info.setdefault("barcode_changes", [])
+    for o in sess.new | sess.dirty:
+        if isinstance(o, StockUnit):
+            changes.append(("set", o.barcode, o.id, o.status))
+        elif isinstance(o, StockMovement) and o.barcode:
+            changes.append(("move", o.barcode, o.unit_id, o.kind))
+    for o in sess.deleted:
+        if isinstance(o, StockUnit):
+            changes.append(("del", o.barcode, o.id, None))
+
+@event.listens_for(OrmSession, "after_commit")
+def _apply_barcode_changes(sess):
+    for op, barcode, unit_id, extra in sess.info.pop("barcode_changes", []):
+        if op == "set":
+            barcode_index.set(barcode, unit_id, extra)
+        elif op == "move":
+            barcode_index.apply_movement(barcode, unit_id, extra)
+        else:
+            barcode_index.remove(barcode)
+
+@event.listens_for(OrmSession, "after_rollback")
+def _drop_barcode_changes(sess):
+    sess.info.pop("barcode_changes", None)
+
+@app.get("/admin/barcode-index")
+def barcode_index_stats():
+    return jsonify({"ok": True, **barcode_index.stats()})
+
+@app.post("/admin/barcode-index/rebuild")
+def barcode_index_rebuild():
+    t0 = time.perf_counter()
+    barcode_index.rebuild()
+    return jsonify({"ok": True, "seconds": round(time.perf_counter() - t0, 3), **barcode_index.stats()})
+
+@app.cli.command("barcode-index-bench")
+@click.option("--n", default=1_000_000, help="Number of synthetic barcodes.")
+def barcode_index_bench(n):
+    """Build an index of N synthetic barcodes and report memory and lookup cost."""
+    import tracemalloc
+    rows = lambda: ((f"LB{i:010d}", i, "In Stock") for i in range(n))
+    idx = BarcodeIndex()
+    t0 = time.perf_counter()
+    idx.build_from(rows())
+    build_s = time.perf_counter() - t0
+    tracemalloc.start()  # second build under tracemalloc, which slows allocation too much to time
+    idx = BarcodeIndex()
+    idx.build_from(rows())
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    probes = 100_000
+    t0 = time.perf_counter()
+    hits = sum(1 for i in range(0, n, max(1, n // probes)) if idx.lookup(f"LB{i:010d}"))
+    hit_us = (time.perf_counter() - t0) / max(hits, 1) * 1e6
+    t0 = time.perf_counter()
+    false_pos = sum(1 for i in range(probes) if _barcode_hash(f"MISS{i}") in idx._snapshot[0])
+    miss_us = (time.perf_counter() - t0) / probes * 1e6
+    click.echo(f"barcodes={n} build={build_s:.1f}s resident={current / 2**20:.1f}MiB peak={peak / 2**20:.1f}MiB "
+               f"index={idx.memory_bytes() / 2**20:.1f}MiB hit={hit_us:.1f}us miss={miss_us:.1f}us "
+               f"bloom_fp={false_pos / probes:.4f}")
+
 @app.route("/stock")
+@read_replica
+@cached_page("stock", ("stock_item", "stock_unit", "stock_movement", "stock_snapshot"))
 def stock():
     user = session.get("user")
     items = StockItem.query.order_by(StockItem.id.desc()).all()
+    with db_route("primary"):  # may write; must not decide from a lagging replica
+        maybe_snapshot_stock()
+    levels = stock_levels()
     counts = {}
     by_provider = {}
     batch_summary = {}
     for i in items:
         prov = normalize_provider(i.provider) or "Unassigned"
-        total = db.session.query(func.count(StockUnit.id)).filter(StockUnit.item_id == i.id).scalar()
-        in_stock = db.session.query(func.count(StockUnit.id)).filter(StockUnit.item_id == i.id, StockUnit.status == "In Stock").scalar()
-        counts[i.id] = {"total": total, "in_stock": in_stock}
+        counts[i.id] = levels.get(i.id, {"total": 0, "in_stock": 0})
         by_provider.setdefault(prov, []).append(i)
         batch_summary[i.id] = batch_summary_for_item(i.id)
     providers_sorted = sorted([p for p in by_provider.keys() if p != "Unassigned"]) + (["Unassigned"] if "Unassigned" in by_provider else [])
@@ -569,6 +1985,7 @@ def create_item():
         request_datetime=None,
         current_stock=int(request.form.get("current_stock",0)),
         provider=normalize_provider(request.form.get("provider")) or "Unassigned",
+        sku=(request.form.get("sku") or "").strip() or None,
     )
     if not item.name:
         flash("Name is required.", "error"); return redirect(url_for("new_item"))
@@ -590,19 +2007,37 @@ def add_unit_one(item_id):
     batch_number = (request.form.get("batch_number") or "").strip() or None
     if not barcode:
         flash("Scan or enter a barcode.", "error"); return redirect(url_for("manage_units", item_id=item_id))
-    if StockUnit.query.filter_by(barcode=barcode).first():
+    if lookup_barcode(barcode):
         flash("This barcode already exists.", "error"); return redirect(url_for("manage_units", item_id=item_id))
     u = StockUnit(barcode=barcode, batch_number=batch_number, item_id=item_id, status="In Stock", last_update=datetime.now(timezone.utc))
-    db.session.add(u); db.session.commit()
+    try:
+        db.session.add(u); db.session.flush()
+        record_stock_movement(u, "add")
+        db.session.commit()
+    except IntegrityError:  # added by another worker since the index last synced
+        db.session.rollback()
+        flash("This barcode already exists.", "error"); return redirect(url_for("manage_units", item_id=item_id))
     flash(f"Added barcode {barcode}.", "success")
     return redirect(url_for("manage_units", item_id=item_id))
 
+def _insert_units(item_id, rows):
+    """Insert (barcode, batch_number) rows as In Stock units with their ledger entries; commits."""
+    now = datetime.now(timezone.utc)
+    new_units = [StockUnit(barcode=b, batch_number=batch, item_id=item_id, status="In Stock", last_update=now)
+                 for b, batch in rows]
+    db.session.add_all(new_units)
+    db.session.flush()
+    for u in new_units:
+        record_stock_movement(u, "add")
+    db.session.commit()
+    return len(new_units)
+
 @app.post("/item/<int:item_id>/units/add_bulk")
 def add_units_bulk(item_id):
     item = StockItem.query.get_or_404(item_id)
     raw = request.form.get("barcodes","")
     default_batch = (request.form.get("batch_number") or "").strip() or None
-    new_count = 0
+    rows, seen = [], set()
     for line in raw.splitlines():
         line = line.strip()
         if not line: 
@@ -613,31 +2048,105 @@ def add_units_bulk(item_id):
         if not barcode:
             continue
         batch_no = parts[1] if len(parts) > 1 else default_batch
-        if StockUnit.query.filter_by(barcode=barcode).first():
+        if barcode in seen or lookup_barcode(barcode):
             continue
-        db.session.add(StockUnit(barcode=barcode, batch_number=batch_no, item_id=item_id, status="In Stock", last_update=datetime.now(timezone.utc)))
-        new_count += 1
-    db.session.commit()
-    flash(f"Added {new_count} barcodes.", "success")
+        seen.add(barcode)
+        rows.append((barcode, batch_no))
+    try:
+        added = _insert_units(item_id, rows)
+    except IntegrityError:
+        # some were added by another worker since the index last synced: skip exactly those
+        db.session.rollback()
+        taken = set()
+        for chunk in _chunks(b for b, _ in rows):
+            taken.update(b for (b,) in db.session.query(StockUnit.barcode).filter(StockUnit.barcode.in_(chunk)))
+        added = _insert_units(item_id, [r for r in rows if r[0] not in taken])
+    flash(f"Added {added} barcodes.", "success")
     return redirect(url_for("manage_units", item_id=item_id))
 
 @app.post("/unit/<int:unit_id>/delete")
 def delete_unit(unit_id):
     u = StockUnit.query.get_or_404(unit_id)
-    if OrderUnit.query.filter_by(unit_id=unit_id).first():
+    if (OrderUnit.query.filter_by(unit_id=unit_id).first()
+            or db.session.query(order_unit_archive.c.id).filter(order_unit_archive.c.unit_id == unit_id).first()):
         flash("Cannot delete: unit assigned to order.", "error")
         return redirect(url_for("manage_units", item_id=u.item_id))
     item_id = u.item_id
+    record_stock_movement(u, "delete")
     db.session.delete(u); db.session.commit()
     flash("Unit deleted.", "success")
     return redirect(url_for("manage_units", item_id=item_id))
 
 # ---------------- Tasks ----------------
+TASK_STATUSES = ("Open", "In Progress", "Done")
+TASK_OPEN_STATUSES = ("Open", "In Progress")
+TASK_DUE_WINDOWS = ("overdue", "today", "week", "none")
+TASKS_PER_PAGE = 50
+
+def _task_filters(args, with_status=True):
+    """WHERE clauses for the task board from request args.
+
+    status: a TASK_STATUSES value, "open" (default, hides Done) or "all".
+    due: overdue | today | week (due within 7 days, overdue included) | none.
+    """
+    conds = []
+    if args.get("assignee"):
+        conds.append(Task.assignee == args["assignee"])
+    if args.get("provider"):
+        conds.append(Task.provider == normalize_provider(args["provider"]))
+    status = args.get("status") or "open"
+    if with_status and status != "all":
+        conds.append(Task.status.in_(TASK_OPEN_STATUSES) if status == "open" else Task.status == status)
+    today = date.today()
+    due = args.get("due")
+    if due == "overdue":
+        conds.append(Task.due_date < today)
+    elif due == "today":
+        conds.append(Task.due_date == today)
+    elif due == "week":
+        conds.append(Task.due_date <= today + timedelta(days=7))
+    elif due == "none":
+        conds.append(Task.due_date.is_(None))
+    if due in ("overdue", "today", "week") and (not with_status or status == "all"):
+        conds.append(Task.status != "Done")  # a finished task is never "due"
+    return conds
+
+def task_counts(args):
+    """{status: n} for the current assignee/provider/due filters, plus overdue and due-this-week.
+
+    One indexed GROUP BY, cached until the task table changes.
+    """
+    keys = {k: args.get(k) or "" for k in ("assignee", "provider", "due")}
+    def build():
+        conds = _task_filters(keys, with_status=False)
+        counts = dict.fromkeys(TASK_STATUSES, 0)
+        counts.update(db.session.query(Task.status, func.count(Task.id)).filter(*conds).group_by(Task.status).all())
+        for window in ("overdue", "week"):
+            counts[window] = Task.query.filter(*_task_filters({**keys, "due": window, "status": "open"})).count()
+        return json.dumps(counts)
+    return json.loads(cached_fragment("task_counts", ["task"], build, *sorted(keys.items())))
+
 @app.route("/tasks")
+@read_replica
 def tasks_home():
     user = session.get("user")
-    q = Task.query.order_by(Task.status.desc(), Task.due_date.asc().nullslast(), Task.created_at.desc()).all()
-    return render_template("tasks.html", user=user, tasks=q)
+    args = request.args
+    if args.get("due") and args["due"] not in TASK_DUE_WINDOWS:
+        abort(400)
+    per_page = min(max(args.get("per_page", TASKS_PER_PAGE, type=int), 1), 200)
+    q = Task.query.filter(*_task_filters(args))
+    if args.get("status") in TASK_STATUSES:
+        q = q.order_by(Task.due_date.asc().nullslast(), Task.created_at.desc())
+    else:
+        q = q.order_by(Task.status.desc(), Task.due_date.asc().nullslast(), Task.created_at.desc())
+    page = q.paginate(page=args.get("page", 1, type=int), per_page=per_page, error_out=False)
+    counts = task_counts(args)
+    filters = {k: args.get(k, "") for k in ("assignee", "provider", "status", "due")}
+    if _wants_json():
+        return jsonify({"ok": True, "data": [_task_json(t) for t in page.items], "counts": counts,
+                        "page": page.page, "pages": page.pages, "total": page.total, "filters": filters})
+    return render_template("tasks.html", user=user, tasks=page.items, pagination=page,
+                           counts=counts, filters=filters)
 
 @app.post("/tasks/add")
 def tasks_add():
@@ -691,6 +2200,8 @@ def _wb_from_list_dict(rows, headers):
     return wb
 
 @app.route("/export/practitioners.xlsx")
+@read_replica
+@rate_limit("6/minute", algorithm="sliding_window")
 def export_practitioners():
     seed_demo_if_empty()
     rows = []
@@ -715,6 +2226,8 @@ def export_practitioners():
     return send_file(bio, as_attachment=True, download_name="practitioners.xlsx", mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
 @app.route("/export/orders.xlsx")
+@read_replica
+@rate_limit("6/minute", algorithm="sliding_window")
 def export_orders():
     seed_demo_if_empty()
     rows = []
@@ -740,15 +2253,190 @@ def export_orders():
     bio = BytesIO(); wb.save(bio); bio.seek(0)
     return send_file(bio, as_attachment=True, download_name="orders.xlsx", mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
+# ---------------- Analytics (time-bucketed aggregates) ----------------
+REPORT_PERIODS = ("day", "week", "month")
+FUNNEL_STAGES = ["sent_out", "received_back", "kit_registered", "results_sent", "paid", "invoiced"]
+
+def _is_sqlite():
+    return db.engine.dialect.name == "sqlite"
+
+def _bucket_expr(col, period):
+    """SQL expression mapping a timestamp to the 'YYYY-MM-DD' start of its bucket."""
+    if _is_sqlite():
+        if period == "day":
+            return func.date(col)
+        if period == "week":
+            return func.date(col, "weekday 0", "-6 days")  # Monday
+        return func.strftime("%Y-%m-01", col)
+    return func.to_char(func.date_trunc(period, col), "YYYY-MM-DD")
+
+def _hours_between_expr(start_col, end_col):
+    if _is_sqlite():
+        return (func.julianday(end_col) - func.julianday(start_col)) * 24.0
+    return func.extract("epoch", end_col - start_col) / 3600.0
+
+def _bucket_start(d, period):
+    if period == "week":
+        return d - timedelta(days=d.weekday())
+    if period == "month":
+        return d.replace(day=1)
+    return d
+
+def _next_bucket(d, period):
+    if period == "week":
+        return d + timedelta(days=7)
+    if period == "month":
+        return (d.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return d + timedelta(days=1)
+
+def _bucket_labels(start, end, period):
+    labels = []
+    d = _bucket_start(start, period)
+    while d <= end:
+        labels.append(d.isoformat())
+        d = _next_bucket(d, period)
+    return labels
+
+def _percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return None
+    k = (len(sorted_vals) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_vals) - 1)
+    return round(sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo), 1)
+
+def _orders_source():
+    """Hot and archived orders as one selectable, so reports span the whole history."""
+    names = ["id", "provider", "created_at", "completed_at", *FUNNEL_STAGES]
+    return db.union_all(
+        db.select(*[Order.__table__.c[n] for n in names]),
+        db.select(*[order_archive.c[n] for n in names]),
+    ).subquery("orders_all")
+
+def _compute_volume(period, start, end, provider):
+    """{bucket: {provider: {"created": n, "completed": n}}} from two grouped queries."""
+    out = {}
+    o = _orders_source()
+    for key, col in (("created", o.c.created_at), ("completed", o.c.completed_at)):
+        b = _bucket_expr(col, period)
+        q = (db.session.query(b, o.c.provider, func.count(o.c.id))
+             .filter(col >= start, col < end))
+        if provider != "*":
+            q = q.filter(o.c.provider == provider)
+        for label, prov, n in q.group_by(b, o.c.provider):
+            cell = out.setdefault(label, {}).setdefault(prov or "Unassigned", {"created": 0, "completed": 0})
+            cell[key] += n
+    return out
+
+def _compute_turnaround(period, start, end, provider):
+    """{bucket: {count, p50, p90, p95, max}} of created_at->completed_at hours, bucketed by completion."""
+    o = _orders_source()
+    b = _bucket_expr(o.c.completed_at, period)
+    hours = _hours_between_expr(o.c.created_at, o.c.completed_at)
+    q = (db.session.query(b, hours)
+         .filter(o.c.completed_at >= start, o.c.completed_at < end, o.c.created_at != None))
+    if provider != "*":
+        q = q.filter(o.c.provider == provider)
+    per_bucket = {}
+    for label, h in q.order_by(b, hours):
+        if h is not None:
+            per_bucket.setdefault(label, []).append(max(float(h), 0.0))
+    return {label: {"count": len(v), "p50": _percentile(v, 50), "p90": _percentile(v, 90),
+                    "p95": _percentile(v, 95), "max": round(v[-1], 1)}
+            for label, v in per_bucket.items()}
+
+REPORT_METRICS = {"volume": _compute_volume, "turnaround": _compute_turnaround}
+
+def report_series(metric, period, start, end, provider=None):
+    """Return [(bucket, payload)] for start..end (dates, inclusive).
+
+    Closed buckets are read from ReportCache; only missing ones and the
+    current (still open) bucket are computed, in a single grouped query.
+    """
+    compute = REPORT_METRICS[metric]
+    provider = normalize_provider(provider) or "*"
+    labels = _bucket_labels(start, end, period)
+    if not labels:
+        return []
+    current = _bucket_start(date.today(), period).isoformat()
+
+    cached = {r.bucket: json.loads(r.payload) for r in ReportCache.query.filter(
+        ReportCache.metric == metric, ReportCache.period == period, ReportCache.provider == provider,
+        ReportCache.bucket >= labels[0], ReportCache.bucket <= labels[-1])}
+    missing = [l for l in labels if l not in cached or l >= current]
+    if missing:
+        lo = datetime.fromisoformat(missing[0])
+        hi = datetime.combine(_next_bucket(date.fromisoformat(missing[-1]), period), datetime.min.time())
+        fresh = compute(period, lo, hi, provider)
+        for label in missing:
+            cached[label] = fresh.get(label) or {}
+            if label < current:
+                db.session.add(ReportCache(metric=metric, period=period, provider=provider,
+                                           bucket=label, payload=json.dumps(cached[label])))
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()  # another worker filled the same buckets
+    return [(l, cached[l]) for l in labels]
+
+def report_funnel(start, end, provider=None):
+    """Workflow-stage counts for orders created in [start, end] in one aggregate query."""
+    o = _orders_source()
+    cols = [func.count(o.c.id)] + [
+        func.sum(db.case((o.c[s] == True, 1), else_=0)) for s in FUNNEL_STAGES]
+    q = db.session.query(*cols).filter(
+        o.c.created_at >= datetime.combine(start, datetime.min.time()),
+        o.c.created_at < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+    provider = normalize_provider(provider)
+    if provider:
+        q = q.filter(o.c.provider == provider)
+    row = q.one()
+    funnel = [{"stage": "created", "count": row[0] or 0}]
+    funnel += [{"stage": s, "count": int(n or 0)} for s, n in zip(FUNNEL_STAGES, row[1:])]
+    return funnel
+
+def invalidate_report_cache(since=None):
+    """Drop cached buckets (all, or every bucket that can contain `since` or later) and commit."""
+    q = ReportCache.query
+    if since:
+        d = since.date() if isinstance(since, datetime) else since
+        first = min(_bucket_start(d, p) for p in REPORT_PERIODS)
+        q = q.filter(ReportCache.bucket >= first.isoformat())
+    q.delete(synchronize_session=False)
+    db.session.commit()
+
+@app.get("/reports/analytics.json")
+@read_replica
+def reports_analytics():
+    period = request.args.get("period", "week")
+    if period not in REPORT_PERIODS:
+        return jsonify({"ok": False, "error": f"period must be one of {', '.join(REPORT_PERIODS)}"}), 400
+    end = parse_date(request.args.get("end")) or date.today()
+    start = parse_date(request.args.get("start")) or end - timedelta(days=365)
+    if start > end:
+        return jsonify({"ok": False, "error": "start must be before end"}), 400
+    provider = request.args.get("provider") or None
+    return jsonify({
+        "ok": True, "period": period, "start": start.isoformat(), "end": end.isoformat(),
+        "provider": normalize_provider(provider),
+        "volume": [{"bucket": b, "providers": p} for b, p in report_series("volume", period, start, end, provider)],
+        "turnaround_hours": [dict(bucket=b, **p) for b, p in report_series("turnaround", period, start, end, provider) if p],
+        "funnel": report_funnel(start, end, provider),
+    })
+
 # ---------------- Uploads (by provider) ----------------
 @app.route("/uploads")
 def uploads_home():
     user = session.get("user")
-    files_by_provider = {}
-    for p in PROVIDERS:
-        rows = Document.query.filter_by(provider=p).order_by(Document.uploaded_at.desc()).all()
-        files_by_provider[p] = rows
-    return render_template("uploads.html", user=user, providers=PROVIDERS, files_by_provider=files_by_provider)
+    providers = provider_names()
+    files_by_provider = {p: [] for p in providers}
+    previews = {}
+    for doc in Document.query.filter(Document.provider.in_(providers)).order_by(Document.uploaded_at.desc()):
+        files_by_provider[doc.provider].append(doc)
+        if previewable(doc.filename):
+            previews[doc.id] = url_for("document_preview", provider=doc.provider, stored_name=doc.stored_name)
+    return render_template("uploads.html", user=user, providers=providers, files_by_provider=files_by_provider,
+                           previews=previews)
 
 @app.post("/uploads/add")
 def upload_file():
@@ -765,12 +2453,14 @@ def upload_file():
     f.save(os.path.join(prov_dir, stored))
     doc = Document(provider=provider or "Unassigned", filename=f.filename, stored_name=stored)
     db.session.add(doc); db.session.commit()
+    if previewable(f.filename):
+        schedule_preview(os.path.join(prov_dir, stored), stored)
     flash("File uploaded.", "success"); return redirect(url_for("uploads_home"))
 
 def _provider_dir_candidates(provider: str):
     norm = normalize_provider(provider) or provider or "Unassigned"
     dirs = [os.path.join(UPLOAD_ROOT, norm.replace(" ", "_"))]
-    for old in REVERSE_MAP.get(norm, []):
+    for old in provider_aliases(norm):
         dirs.append(os.path.join(UPLOAD_ROOT, old.replace(" ", "_")))
     if provider != norm:
         dirs.append(os.path.join(UPLOAD_ROOT, provider.replace(" ", "_")))
@@ -788,60 +2478,337 @@ def download_uploaded(provider, stored_name):
             return send_from_directory(d, stored_name, as_attachment=True)
     abort(404)
 
-# ---------------- Azure demo auth (optional) ----------------
+# ---------------- Document previews ----------------
+# Thumbnails are rendered by preview_render.py in a process pool right after
+# upload and kept in a size-bounded directory; least recently served files
+# are evicted first (mtime is bumped on every hit). stored_name is unique per upload, so a
+# preview URL never changes content and is cached by browsers for a year.
+PREVIEW_DIR = os.environ.get("PREVIEW_CACHE_DIR", os.path.join(BASE_DIR, "previews"))
+PREVIEW_CACHE_MB = float(os.environ.get("PREVIEW_CACHE_MB", "256"))
+PREVIEW_SIZE = int(os.environ.get("PREVIEW_SIZE", "320"))
+PREVIEW_WORKERS = int(os.environ.get("PREVIEW_WORKERS", "2"))
+PREVIEW_MAX_AGE = 365 * 24 * 3600
+PREVIEW_IMAGE_EXT = {"png", "jpg", "jpeg"}
+
+def previewable(filename):
+    ext = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    if Image is None:
+        return False
+    return ext in PREVIEW_IMAGE_EXT or (ext == "pdf" and (fitz is not None or shutil.which("pdftoppm")))
+
+class PreviewCache:
+    """Directory of rendered thumbnails bounded to max_bytes, evicting least recently used."""
+    def __init__(self, root, max_bytes):
+        self.root, self.max_bytes = root, max_bytes
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = None  # computed lazily from the directory
+        self._pending = set()
+        self._pool = None
+
+    def path(self, stored_name):
+        return os.path.join(self.root, hashlib.sha1(stored_name.encode()).hexdigest()[:20] + f"-{PREVIEW_SIZE}.jpg")
+
+    def get(self, stored_name):
+        p = self.path(stored_name)
+        try:
+            os.utime(p)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        return p
+
+    def schedule(self, src, stored_name):
+        with self._lock:
+            if stored_name in self._pending:
+                return
+            if self._pool is None:
+                # not fork: this process runs threads (schedulers, index builds) whose locks a fork would copy
+                self._pool = ProcessPoolExecutor(max_workers=PREVIEW_WORKERS,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            self._pending.add(stored_name)
+            fut = self._pool.submit(render_preview, src, self.path(stored_name), PREVIEW_SIZE)
+        fut.add_done_callback(lambda f: self._done(stored_name, f))
+
+    def _done(self, stored_name, fut):
+        with self._lock:
+            self._pending.discard(stored_name)
+        try:
+            added = fut.result()
+        except Exception as e:
+            print("preview error:", stored_name, e)
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size += added
+            if self._size is None or self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Rescan the directory (other workers write here too) and trim to 90% of the budget."""
+        files = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.name.endswith(".jpg"):
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+        self._size = sum(f[1] for f in files)
+        if self._size <= self.max_bytes:
+            return
+        for _, size, path in sorted(files):
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except FileNotFoundError:
+                pass
+
+    def pending(self):
+        return len(self._pending)
+
+preview_cache = PreviewCache(PREVIEW_DIR, int(PREVIEW_CACHE_MB * 1024 * 1024))
+HEALTH_QUEUES["previews_pending"] = preview_cache.pending
+
+def schedule_preview(src, stored_name):
+    if not os.path.exists(preview_cache.path(stored_name)):
+        preview_cache.schedule(src, stored_name)
+
+@app.get("/uploads/<provider>/<stored_name>/preview")
+def document_preview(provider, stored_name):
+    """JPEG thumbnail; 202 + Retry-After while it is still being rendered."""
+    if not previewable(stored_name):
+        abort(404)
+    cached = preview_cache.get(stored_name)
+    if cached:
+        resp = send_file(cached, mimetype="image/jpeg", max_age=PREVIEW_MAX_AGE, conditional=True)
+        resp.headers["Cache-Control"] = f"private, max-age={PREVIEW_MAX_AGE}, immutable"
+        return resp
+    for d in _provider_dir_candidates(provider):
+        src = safe_join(d, stored_name)
+        if src and os.path.isfile(src):
+            schedule_preview(src, stored_name)
+            return jsonify({"ok": True, "status": "pending"}), 202, {"Retry-After": "1", "Cache-Control": "no-store"}
+    abort(404)
+
+# ---------------- Azure AD auth (optional) ----------------
+SESSION_STORE = os.environ.get("SESSION_STORE", "sqlite")  # sqlite | cookie
+SESSION_DB_PATH = os.environ.get("SESSION_DB_PATH", os.path.join(DATA_DIR, "sessions.db"))  # holds MSAL tokens
+SESSION_TTL = timedelta(hours=int(os.environ.get("SESSION_TTL_HOURS", "12")))
+TOKEN_CACHE_TTL = timedelta(days=int(os.environ.get("TOKEN_CACHE_TTL_DAYS", "14")))
+
+class SqliteStore:
+    """Small key/value store with per-key expiry in a local SQLite file, shared by workers.
+
+    The file holds refresh tokens, so it is created readable by the app's user only.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+        self._conn().execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS ix_kv_expires ON kv (expires)")
+
+    def _conn(self):
+        if getattr(self._local, "conn", None) is None:
+            self._local.conn = sqlite_connect(self.path)
+        return self._local.conn
+
+    def get(self, key):
+        """(value, expires_epoch) or (None, None) if missing/expired."""
+        row = self._conn().execute("SELECT value, expires FROM kv WHERE key = ? AND expires > ?",
+                                   (key, time.time())).fetchone()
+        return (row[0], row[1]) if row else (None, None)
+
+    def set(self, key, value, ttl):
+        self._conn().execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                             (key, value, time.time() + ttl.total_seconds()))
+        if uuid.uuid4().int % 100 == 0:  # amortized eviction
+            self.purge_expired()
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def purge_expired(self):
+        return self._conn().execute("DELETE FROM kv WHERE expires <= ?", (time.time(),)).rowcount
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, expires=None):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid, self.new, self.expires = sid, new, expires
+        self.modified = False
+        self.replaced_sid = None
+
+    def rotate(self):
+        """Move the data to a fresh id (on login) so a pre-login id can't be fixed on a victim."""
+        self.replaced_sid = self.replaced_sid or (None if self.new else self.sid)
+        self.sid, self.new, self.modified = uuid.uuid4().hex, True, True
+
+class SqliteSessionInterface(SessionInterface):
+    """Server-side sessions: the cookie carries only a signed random id."""
+    serializer = session_json_serializer
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="server-session")
+
+    def open_session(self, app, request):
+        signed = request.cookies.get(self.get_cookie_name(app))
+        if signed:
+            try:
+                sid = self._signer(app).unsign(signed).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                value, expires = self.store.get(f"sess:{sid}")
+                if value is not None:
+                    return ServerSession(self.serializer.loads(value), sid=sid, expires=expires)
+        return ServerSession(sid=uuid.uuid4().hex, new=True)
+
+    def save_session(self, app, session, response):
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.replaced_sid:
+            self.store.delete(f"sess:{session.replaced_sid}")
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(f"sess:{session.sid}")
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        # write on change, or slide the expiry once half the TTL has passed
+        stale = session.expires is None or session.expires - time.time() < SESSION_TTL.total_seconds() / 2
+        if session.modified or stale:
+            self.store.set(f"sess:{session.sid}", self.serializer.dumps(dict(session)), SESSION_TTL)
+        if session.new or stale:
+            response.set_cookie(name, self._signer(app).sign(session.sid).decode(),
+                                max_age=int(SESSION_TTL.total_seconds()), httponly=True, domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+        response.vary.add("Cookie")
+
+auth_store = SqliteStore(SESSION_DB_PATH)
+if SESSION_STORE == "sqlite":
+    app.session_interface = SqliteSessionInterface(auth_store)
+
+_MSAL_HTTP_CACHE = {}  # authority/instance discovery responses, shared by every MSAL app in this process
+_msal_lock = threading.Lock()
+_msal_singleton = None
+_graph = requests.Session()  # keep-alive for Graph calls
+
+def _msal_app():
+    """Process-wide app for calls that need no user token cache (auth URLs, flows)."""
+    global _msal_singleton
+    with _msal_lock:
+        if _msal_singleton is None:
+            _msal_singleton = _build_msal_app()
+        return _msal_singleton
+
 def _build_msal_app(cache=None, authority=None):
     return msal.ConfidentialClientApplication(
-        CLIENT_ID, authority=authority or f"https://login.microsoftonline.com/{TENANT_ID}",
-        client_credential=CLIENT_SECRET, token_cache=cache
+        CLIENT_ID, authority=authority or AUTHORITY,
+        client_credential=CLIENT_SECRET, token_cache=cache, http_cache=_MSAL_HTTP_CACHE,
     )
 
-def _build_auth_url(scopes=None, state=None):
-    from flask import url_for
-    return _build_msal_app().get_authorization_request_url(
-    scopes or ["User.Read"],
-    state=state or "default",
-    redirect_uri=url_for("authorized", _external=True)
-    )
+def _load_token_cache(account_id):
+    cache = msal.SerializableTokenCache()
+    if account_id:
+        blob, _ = auth_store.get(f"tok:{account_id}")
+        if blob:
+            cache.deserialize(blob.decode() if isinstance(blob, bytes) else blob)
+    return cache
+
+def _save_token_cache(account_id, cache):
+    if account_id and cache.has_state_changed:
+        auth_store.set(f"tok:{account_id}", cache.serialize(), TOKEN_CACHE_TTL)
+
+def get_access_token(scopes=None):
+    """Access token for the signed-in user from the cache, refreshed silently when needed."""
+    account_id = session.get("account_id")
+    if not account_id:
+        return None
+    cache = _load_token_cache(account_id)
+    cca = _build_msal_app(cache)
+    account = next((a for a in cca.get_accounts() if a.get("home_account_id") == account_id), None)
+    if account is None:
+        return None
+    result = cca.acquire_token_silent(scopes or SCOPE.split(), account=account)
+    _save_token_cache(account_id, cache)
+    return (result or {}).get("access_token")
+
+def graph_get(path, scopes=None):
+    token = get_access_token(scopes)
+    if not token:
+        return None
+    resp = _graph.get(f"https://graph.microsoft.com/v1.0/{path.lstrip('/')}",
+                      headers={"Authorization": f"Bearer {token}"}, timeout=15)
+    return resp.json() if resp.ok else None
+
+def _rotate_session_id():
+    if isinstance(session._get_current_object(), ServerSession):
+        session.rotate()
 
 @app.route("/login")
 def login():
     if not os.environ.get("AZURE_CLIENT_ID"):
         flash("Azure AD not configured (demo login).", "error")
         return redirect(url_for("dashboard"))
-    return redirect(_build_auth_url())
+    flow = _msal_app().initiate_auth_code_flow(SCOPE.split(), redirect_uri=url_for("authorized", _external=True))
+    session["auth_flow"] = flow
+    return redirect(flow["auth_uri"])
 
 @app.route(REDIRECT_PATH)
 def authorized():
-    session["user"] = {"name":"Demo User","preferred_username":"demo@example.com"}
-    flash("Signed in (demo). Configure Azure to enable real auth.", "success")
+    if not os.environ.get("AZURE_CLIENT_ID"):
+        _rotate_session_id()
+        session["user"] = {"name":"Demo User","preferred_username":"demo@example.com"}
+        flash("Signed in (demo). Configure Azure to enable real auth.", "success")
+        return redirect(url_for("dashboard"))
+    cache = msal.SerializableTokenCache()
+    cca = _build_msal_app(cache)
+    try:
+        result = cca.acquire_token_by_auth_code_flow(session.pop("auth_flow", {}), request.args)
+    except ValueError:  # state mismatch / replayed callback
+        result = {"error": "invalid_state"}
+    if "error" in result:
+        flash(f"Sign-in failed: {result.get('error_description') or result['error']}", "error")
+        return redirect(url_for("dashboard"))
+    claims = result.get("id_token_claims") or {}
+    accounts = cca.get_accounts()
+    account_id = accounts[0]["home_account_id"] if accounts else None
+    _rotate_session_id()
+    session["user"] = {"name": claims.get("name"), "preferred_username": claims.get("preferred_username"),
+                       "oid": claims.get("oid")}
+    session["account_id"] = account_id
+    _save_token_cache(account_id, cache)
+    flash("Signed in.", "success")
     return redirect(url_for("dashboard"))
 
+@app.get("/api/me")
+def api_me():
+    if not session.get("user"):
+        return jsonify({"ok": False, "error": "not signed in"}), 401
+    return jsonify({"ok": True, "user": session["user"], "graph": graph_get("me")})
+
 @app.route("/logout")
 def logout():
+    account_id = session.get("account_id")
+    if account_id:
+        auth_store.delete(f"tok:{account_id}")
     session.clear()
     params = {"post_logout_redirect_uri": url_for("dashboard", _external=True)}
-    authority = os.environ.get("AZURE_AUTHORITY", f"https://login.microsoftonline.com/{TENANT_ID}")
-    return redirect(f"{authority}/oauth2/v2.0/logout?{urlencode(params)}")
+    return redirect(f"{AUTHORITY}/oauth2/v2.0/logout?{urlencode(params)}")
 
 # ---------------- One-time DB rename utility ----------------
 def apply_provider_renames_db():
-    changed = False
-    for model in (StockItem, Task, Document):
-        for old, new in RENAME_MAP.items():
-            q = db.session.query(model).filter(getattr(model, 'provider') == old)
-            if q.count():
-                q.update({'provider': new})
-                changed = True
-    if changed:
-        db.session.commit()
+    migrate_providers_db()
 
 
 
 
 @app.get("/orders/new")
 def new_order_form():
-    providers = ["Geneway","Optiway","Enbiosis","Reboot","Intelligene","Healthy Me","Intelligene Fedhealth","Geko"]
-    return render_template("order_new.html", user=session.get("user"), providers=providers)
+    return render_template("order_new.html", user=session.get("user"), providers=provider_names())
 
 @app.post("/orders/new")
 def create_order():
@@ -860,8 +2827,9 @@ def create_order():
               notes=notes, ordered_at=ordered_at, status=status, created_at=datetime.now(timezone.utc))
     db.session.add(o); db.session.flush()
 
-    # Up to 3 items from form fields item_sku_1..3, item_qty_1..3
-    for i in range(1, 4):
+    # Items from form fields item_sku_N / item_qty_N (any number of rows)
+    idx = sorted(int(m.group(1)) for m in (re.fullmatch(r"item_sku_(\d+)", k) for k in request.form) if m)
+    for i in idx:
         sku = (request.form.get(f"item_sku_{i}") or "").strip()
         qty = request.form.get(f"item_qty_{i}")
         if sku and qty:
@@ -872,6 +2840,248 @@ def create_order():
     flash(f"Order #{o.id} created.", "success")
     return redirect(url_for("orders"))
 
+# ---------------- Bulk order import / bulk workflow updates ----------------
+ORDER_FLAGS = ["sent_out", "received_back", "kit_registered", "results_sent", "paid", "invoiced"]
+IMPORT_FIELDS = {  # normalized header -> Order attribute / item field
+    "provider": "provider", "name": "name", "surname": "surname",
+    "practitioner": "practitioner_name", "practitionername": "practitioner_name",
+    "orderedat": "ordered_at", "status": "status", "notes": "notes", "emailstatus": "email_status",
+    "items": "items", "sku": "sku", "qty": "qty", "quantity": "qty", "ref": "ref", "orderref": "ref",
+    **{f.replace("_", ""): f for f in ORDER_FLAGS},
+}
+IMPORT_TEXT_FIELDS = {"provider", "name", "surname", "practitioner_name", "status", "notes", "email_status", "sku"}
+
+def _wants_json():
+    return request.is_json or request.args.get("format") == "json" or request.accept_mimetypes.best == "application/json"
+
+def _as_bool(v):
+    if isinstance(v, bool):
+        return v
+    return str(v or "").strip().lower() in ("on", "true", "1", "yes", "y")
+
+def _import_rows_from_upload(f):
+    """Yield dict rows (normalized keys) from a CSV, XLSX or JSON upload."""
+    ext = f.filename.rsplit(".", 1)[-1].lower() if "." in f.filename else ""
+    if ext == "json":
+        data = json.load(f.stream)
+        return data.get("orders", []) if isinstance(data, dict) else data
+    if ext == "xlsx":
+        try:
+            ws = load_workbook(f.stream, read_only=True, data_only=True).active
+            rows = ws.iter_rows(values_only=True)
+            headers = [str(h or "") for h in next(rows, [])]
+            return [dict(zip(headers, r)) for r in rows if any(v not in (None, "") for v in r)]
+        except (zipfile.BadZipFile, InvalidFileException, KeyError, OSError):
+            raise ValueError("Could not read the .xlsx file; is it a valid Excel workbook?")
+    if ext == "csv":
+        text = f.stream.read().decode("utf-8-sig")
+        return list(csv.DictReader(text.splitlines()))
+    raise ValueError("Upload a .csv, .xlsx or .json file.")
+
+def _parse_items(v):
+    """Items as a list of {sku, qty} dicts or the export format 'SKU x2; SKU2 x1'."""
+    if isinstance(v, list):
+        if not all(isinstance(it, dict) for it in v):
+            raise ValueError("items must be a list of {sku, qty} objects")
+        return [{"sku": str(it.get("sku") or "").strip(), "qty": it.get("qty", 1)} for it in v]
+    out = []
+    for part in str(v or "").split(";"):
+        m = re.fullmatch(r"\s*(.+?)(?:\s+x\s*(\d+))?\s*", part)
+        if m and m.group(1).strip():
+            out.append({"sku": m.group(1).strip(), "qty": m.group(2) or 1})
+    return out
+
+def _orders_from_rows(rows):
+    """Group raw rows into order dicts. Returns (orders, errors); rows are 1-based."""
+    orders, by_ref, errors = [], {}, []
+    for n, raw in enumerate(rows, start=1):
+        if not isinstance(raw, dict):
+            errors.append({"row": n, "error": "row must be an object of column: value"})
+            continue
+        row = {}
+        for k, v in raw.items():
+            key = IMPORT_FIELDS.get(re.sub(r"[^a-z]", "", str(k).lower()))
+            if key in IMPORT_TEXT_FIELDS and v is not None and not isinstance(v, str):
+                v = v if isinstance(v, (list, dict)) else str(v)  # XLSX/JSON numbers in text columns
+            if key:
+                row[key] = v.strip() if isinstance(v, str) else v
+        try:
+            bad = sorted(k for k in IMPORT_TEXT_FIELDS if isinstance(row.get(k), (list, dict)))
+            if bad:
+                raise ValueError(f"{', '.join(bad)} must be text")
+            items = _parse_items(row.get("items"))
+            if row.get("sku"):
+                items.append({"sku": str(row["sku"]), "qty": row.get("qty") or 1})
+            for it in items:
+                try:
+                    it["qty"] = int(it["qty"])
+                except (TypeError, ValueError):
+                    raise ValueError(f"bad qty {it['qty']!r} for SKU {it['sku']!r}")
+                if not it["sku"] or it["qty"] < 1:
+                    raise ValueError("items need a SKU and a positive qty")
+            ref = row.get("ref")
+            if ref not in (None, "") and ref in by_ref:
+                by_ref[ref]["items"].extend(items)
+                continue
+            ordered_at = row.get("ordered_at")
+            if ordered_at and not isinstance(ordered_at, datetime):
+                ordered_at = datetime.fromisoformat(str(ordered_at))
+            if not (row.get("provider") or row.get("name") or row.get("surname")):
+                raise ValueError("provider, name or surname is required")
+            o = {
+                "row": n, "items": items,
+                "provider": normalize_provider(row.get("provider")) or None,
+                "name": row.get("name") or None, "surname": row.get("surname") or None,
+                "practitioner_name": row.get("practitioner_name") or None,
+                "ordered_at": ordered_at or datetime.now(timezone.utc),
+                "status": row.get("status") or "Pending", "notes": row.get("notes") or None,
+                "email_status": row.get("email_status") or None,
+                **{f: _as_bool(row.get(f)) for f in ORDER_FLAGS},
+            }
+            orders.append(o)
+            if ref not in (None, ""):
+                by_ref[ref] = o
+        except (ValueError, TypeError) as e:
+            errors.append({"row": n, "error": str(e)})
+    return orders, errors
+
+def import_orders(orders):
+    """Insert parsed orders and their items with two executemany INSERTs; caller commits."""
+    now = datetime.now(timezone.utc)
+    values = []
+    for o in orders:
+        v = {k: o[k] for k in ("provider", "name", "surname", "practitioner_name", "ordered_at",
+                               "status", "notes", "email_status", *ORDER_FLAGS)}
+        v["provider_id"] = resolve_provider(v["provider"])[0] if v["provider"] else None
+        v["created_at"] = now
+        v["completed_at"] = now if v["status"].lower().startswith("completed") else None
+        values.append(v)
+    ids = db.session.scalars(insert(Order).returning(Order.id, sort_by_parameter_order=True), values).all()
+    item_rows = [{"order_id": oid, "sku": it["sku"], "qty": it["qty"]}
+                 for oid, o in zip(ids, orders) for it in o["items"]]
+    if item_rows:
+        db.session.execute(insert(OrderItem), item_rows)
+    return ids
+
+@app.post("/orders/import")
+def orders_import():
+    """Bulk-create orders from a CSV/XLSX/JSON upload or a JSON body.
+
+    All-or-nothing by default; pass partial=1 to insert the valid rows and
+    report the rest.
+    """
+    partial = _as_bool(request.values.get("partial"))
+    try:
+        if request.is_json:
+            data = request.get_json()
+            rows = data.get("orders", []) if isinstance(data, dict) else data
+        else:
+            f = request.files.get("file")
+            if not f or not f.filename:
+                raise ValueError("Choose a file.")
+            rows = _import_rows_from_upload(f)
+        if not isinstance(rows, list):
+            raise ValueError("Expected a list of orders.")
+    except ValueError as e:
+        if _wants_json():
+            return jsonify({"ok": False, "error": str(e)}), 400
+        flash(str(e), "error"); return redirect(url_for("new_order_form"))
+
+    orders, errors = _orders_from_rows(rows)
+    ids = []
+    if orders and (partial or not errors):
+        try:
+            ids = import_orders(orders)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            errors.append({"row": None, "error": f"insert failed: {e}"})
+            ids = []
+    if _wants_json():
+        return jsonify({"ok": not errors, "created": len(ids), "order_ids": ids, "errors": errors}), (200 if ids or not errors else 400)
+    if errors:
+        flash(f"Imported {len(ids)} order(s); {len(errors)} row error(s): " +
+              "; ".join(f"row {e['row']}: {e['error']}" for e in errors[:10]), "error")
+    else:
+        flash(f"Imported {len(ids)} order(s).", "success")
+    return redirect(url_for("orders"))
+
+BULK_FILTER_KEYS = ("provider", "status", "created_after", "created_before")
+
+def _bulk_filter_conds(flt):
+    """(WHERE clauses, error message or None) for a bulk_update filter; unknown keys and bad dates are errors."""
+    unknown = set(flt) - set(BULK_FILTER_KEYS)
+    if unknown:
+        return [], f"Unknown filter fields: {', '.join(sorted(map(str, unknown)))}"
+    conds = []
+    if flt.get("provider"):
+        conds.append(Order.provider == normalize_provider(str(flt["provider"])))
+    if flt.get("status"):
+        conds.append(Order.status.ilike(f"%{flt['status']}%"))
+    dates = {}
+    for key in ("created_after", "created_before"):
+        if flt.get(key):
+            dates[key] = parse_dt(str(flt[key]))
+            if dates[key] is None:
+                return [], f"{key} is not a valid date."
+    if "created_after" in dates:
+        conds.append(Order.created_at >= dates["created_after"])
+    if "created_before" in dates:
+        conds.append(Order.created_at < dates["created_before"])
+    return conds, None
+
+@app.post("/orders/bulk_update")
+def orders_bulk_update():
+    """Set workflow flags/status on many orders with one UPDATE.
+
+    JSON: {"ids": [..]} or {"filter": {"provider", "status", "created_before",
+    "created_after"}} plus {"set": {"paid": true, ...}}. Forms post ids=.. and
+    the flags to set.
+    """
+    data = request.get_json(silent=True) if request.is_json else None
+    if data is None:
+        data = {"ids": request.form.getlist("ids"),
+                "set": {k: request.form[k] for k in ORDER_FLAGS + ["status"] if k in request.form}}
+    changes = data.get("set") or {}
+    values = {f: _as_bool(changes[f]) for f in ORDER_FLAGS if f in changes}
+    status = (changes.get("status") or "").strip()
+    if status:
+        values["status"] = status
+        values["completed_at"] = (func.coalesce(Order.completed_at, datetime.now(timezone.utc))
+                                  if status.lower().startswith("completed") else None)
+    unknown = set(changes) - set(ORDER_FLAGS) - {"status"}
+    if not values or unknown:
+        msg = f"Unknown fields: {', '.join(sorted(unknown))}" if unknown else "Nothing to update."
+        if _wants_json():
+            return jsonify({"ok": False, "error": msg}), 400
+        flash(msg, "error"); return redirect(url_for("orders"))
+
+    flt = data.get("filter") or {}
+    try:
+        ids = [int(i) for i in (data.get("ids") or [])]
+    except (TypeError, ValueError):
+        ids = None
+    conds, msg = _bulk_filter_conds(flt) if isinstance(flt, dict) else ([], "filter must be an object.")
+    if ids:
+        conds.append(Order.id.in_(ids))
+    if not msg and (ids is None or not conds):
+        msg = "Pass a list of order ids or a filter."
+    if msg:  # never fall through to an unfiltered UPDATE of every order
+        if _wants_json():
+            return jsonify({"ok": False, "error": msg}), 400
+        flash(msg, "error"); return redirect(url_for("orders"))
+    q = Order.query.filter(*conds)
+    reopened_since = (q.with_entities(func.min(Order.completed_at)).scalar()
+                      if "completed_at" in values and values["completed_at"] is None else None)
+    n = q.update(values, synchronize_session=False)
+    db.session.commit()
+    if reopened_since:
+        invalidate_report_cache(since=reopened_since)
+    if _wants_json():
+        return jsonify({"ok": True, "updated": n})
+    flash(f"Updated {n} order(s).", "success")
+    return redirect(url_for("orders"))
+
 
 
 import base64, requests
@@ -912,6 +3122,7 @@ def orders_update(order_id):
     o.invoiced = as_bool("invoiced")
 
     # Completed timestamp
+    was_completed = o.completed_at
     if o.status.lower().startswith("completed"):
         if not o.completed_at:
             o.completed_at = datetime.now(timezone.utc)
@@ -921,6 +3132,8 @@ def orders_update(order_id):
     o.email_status = (request.form.get("email_status") or o.email_status or "").strip() or None
 
     db.session.commit()
+    if was_completed and o.completed_at is None:
+        invalidate_report_cache(since=was_completed)  # un-completing changes a closed bucket
     flash(f"Order #{o.id} updated.", "success")
     return redirect(url_for("orders") + f"#o{o.id}")
 
@@ -951,8 +3164,9 @@ def assign_unit(order_id):
         flash("Scan or enter a barcode.", "error")
         return redirect(url_for("orders") + f"#o{order_id}")
 
-    unit = StockUnit.query.filter_by(barcode=barcode).first()
-    if not unit:
+    known = lookup_barcode(barcode)
+    unit = db.session.get(StockUnit, known[0]) if known else None
+    if not unit or unit.barcode != barcode:
         flash("Barcode not found in stock.", "error")
         return redirect(url_for("orders") + f"#o{order_id}")
 
@@ -961,6 +3175,7 @@ def assign_unit(order_id):
         return redirect(url_for("orders") + f"#o{order_id}")
 
     db.session.add(OrderUnit(order_id=order_id, unit_id=unit.id))
+    record_stock_movement(unit, "assign", order_id=order_id)
     unit.status = "Assigned"
     unit.last_update = datetime.now(timezone.utc)
     db.session.commit()
@@ -969,6 +3184,85 @@ def assign_unit(order_id):
     return redirect(url_for("orders") + f"#o{order_id}")
 
 
+def _sku_match(sku):
+    return db.or_(StockItem.sku == sku, db.and_(StockItem.sku == None, StockItem.name == sku))
+
+def allocate_units_fefo(order_id, max_attempts=3):
+    """Reserve In Stock units for an order's items, first-expiry-first-out.
+
+    Units already assigned to the order count towards each SKU. Candidates are
+    ordered by item expiry (unexpired only, undated last), then batch, then age,
+    and reserved with a guarded UPDATE in a single transaction; if another
+    request grabbed a unit in between, the whole allocation is retried.
+    Returns {sku: {"requested", "assigned", "allocated": [barcodes], "short"}}.
+    """
+    order = db.session.get(Order, order_id)
+    if order is None:
+        return None
+    wanted = {}
+    for it in order.items:
+        wanted[it.sku] = wanted.get(it.sku, 0) + (it.qty or 0)
+    today = date.today()
+
+    for _ in range(max_attempts):
+        result, picked = {}, []
+        for sku, qty in wanted.items():
+            have = (db.session.query(func.count(OrderUnit.id))
+                    .join(StockUnit, OrderUnit.unit_id == StockUnit.id)
+                    .join(StockItem, StockUnit.item_id == StockItem.id)
+                    .filter(OrderUnit.order_id == order_id, _sku_match(sku)).scalar())
+            need = max(qty - have, 0)
+            units = []
+            if need:
+                units = (StockUnit.query.join(StockItem, StockUnit.item_id == StockItem.id)
+                         .filter(_sku_match(sku), StockUnit.status == "In Stock",
+                                 db.or_(StockItem.expiry_date == None, StockItem.expiry_date >= today))
+                         .order_by(StockItem.expiry_date.asc().nullslast(), StockUnit.batch_number.asc().nullslast(),
+                                   StockUnit.id.asc())
+                         .limit(need).with_for_update(skip_locked=True).all())
+            picked.extend(units)
+            result[sku] = {"requested": qty, "assigned": have, "allocated": [u.barcode for u in units],
+                           "short": need - len(units)}
+        if not picked:
+            return result
+        now = datetime.now(timezone.utc)
+        ids = [u.id for u in picked]
+        n = (StockUnit.query.filter(StockUnit.id.in_(ids), StockUnit.status == "In Stock")
+             .update({"status": "Assigned", "last_update": now}, synchronize_session=False))
+        if n != len(ids):
+            db.session.rollback()
+            continue
+        for u in picked:
+            db.session.add(OrderUnit(order_id=order_id, unit_id=u.id))
+            record_stock_movement(u, "assign", order_id=order_id)
+        db.session.commit()
+        return result
+    raise RuntimeError("stock changed during allocation; try again")
+
+@app.post("/orders/<int:order_id>/allocate")
+def allocate_order_units(order_id):
+    wants_json = _wants_json()
+    try:
+        result = allocate_units_fefo(order_id)
+    except RuntimeError as e:
+        if wants_json:
+            return jsonify({"ok": False, "error": str(e)}), 409
+        flash(str(e), "error")
+        return redirect(url_for("orders") + f"#o{order_id}")
+    if result is None:
+        if wants_json:
+            return jsonify({"ok": False, "error": "Order not found"}), 404
+        flash("Order not found.", "error")
+        return redirect(url_for("orders"))
+    if wants_json:
+        return jsonify({"ok": True, "order_id": order_id, "items": result})
+    allocated = sum(len(r["allocated"]) for r in result.values())
+    short = sum(r["short"] for r in result.values())
+    flash(f"Allocated {allocated} unit(s) to order #{order_id}" + (f"; {short} short." if short else "."),
+          "error" if short else "success")
+    return redirect(url_for("orders") + f"#o{order_id}")
+
+
 @app.post("/orders/<int:order_id>/unassign/<int:ou_id>")
 def unassign_unit(order_id, ou_id):
     ou = OrderUnit.query.get_or_404(ou_id)
@@ -976,15 +3270,232 @@ def unassign_unit(order_id, ou_id):
         abort(400)
     unit = ou.unit
     db.session.delete(ou)
+    record_stock_movement(unit, "unassign", order_id=order_id)
     unit.status = "In Stock"
     unit.last_update = datetime.now(timezone.utc)
     db.session.commit()
     flash("Unassigned barcode.", "success")
     return redirect(url_for("orders") + f"#o{order_id}")
 
+# ---------------- Barcode scanning sessions ----------------
+# Scans are validated in memory and answered immediately; accepted scans are
+# written in batches (SCAN_FLUSH_SIZE scans or SCAN_FLUSH_SECONDS, whichever
+# comes first). Sessions live in memory in the worker that created them: run
+# a single worker process (threads are fine), or pin clients to a worker,
+# otherwise scans to a session created elsewhere get 404 "unknown session".
+# Pending scans are flushed when the worker exits cleanly (SIGTERM, restart);
+# a hard kill loses at most SCAN_FLUSH_SECONDS of acknowledged scans.
+SCAN_FLUSH_SIZE = int(os.environ.get("SCAN_FLUSH_SIZE", "100"))
+SCAN_FLUSH_SECONDS = float(os.environ.get("SCAN_FLUSH_SECONDS", "2"))
+SCAN_SESSION_IDLE = timedelta(hours=2)
+_scan_sessions = {}
+_scan_sessions_lock = threading.Lock()
+HEALTH_QUEUES["scan_pending"] = lambda: sum(len(s.pending) for s in list(_scan_sessions.values()))
+
+class ScanSession:
+    def __init__(self, mode, item_id=None, order_id=None, batch_number=None):
+        self.id = uuid.uuid4().hex
+        self.mode, self.item_id, self.order_id, self.batch_number = mode, item_id, order_id, batch_number
+        self.pending = []  # barcodes accepted but not yet written
+        self.seen = set()
+        self.accepted = self.flushed = 0
+        self.rejected = []  # {"barcode", "reason"}
+        self.lock = threading.Lock()
+        self.last_flush = self.last_seen = time.time()
+
+    def scan(self, barcode):
+        """Validate one scan in memory; returns None if accepted, else the reason."""
+        barcode = str(barcode or "").strip()
+        if not barcode:
+            return "empty"
+        if barcode in self.seen:
+            return "duplicate scan"
+        known = lookup_barcode(barcode)
+        if self.mode == "intake" and known:
+            return "barcode already exists"
+        if self.mode == "assign":
+            if not known:
+                return "barcode not found in stock"
+            if known[1] != "In Stock":
+                return f"not available (status: {known[1]})"
+        self.seen.add(barcode)
+        self.pending.append(barcode)
+        self.accepted += 1
+        return None
+
+    def due(self):
+        return self.pending and (len(self.pending) >= SCAN_FLUSH_SIZE or time.time() - self.last_flush >= SCAN_FLUSH_SECONDS)
 
+    def flush(self):
+        """Write pending scans in one transaction; rows that lost a race are moved to `rejected`."""
+        batch, self.pending = self.pending, []
+        self.last_flush = time.time()
+        if not batch:
+            return 0
+        try:
+            written = self._write_intake(batch) if self.mode == "intake" else self._write_assign(batch)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self.rejected.extend({"barcode": b, "reason": f"write failed: {e}"} for b in batch)
+            return 0
+        self.flushed += written
+        return written
+
+    def _write_intake(self, batch):
+        taken = set()
+        for chunk in _chunks(batch):
+            taken.update(b for (b,) in db.session.query(StockUnit.barcode).filter(StockUnit.barcode.in_(chunk)))
+        now = datetime.now(timezone.utc)
+        units = [StockUnit(barcode=b, batch_number=self.batch_number, item_id=self.item_id,
+                           status="In Stock", last_update=now) for b in batch if b not in taken]
+        self.rejected.extend({"barcode": b, "reason": "barcode already exists"} for b in batch if b in taken)
+        db.session.add_all(units)
+        db.session.flush()
+        for u in units:
+            record_stock_movement(u, "add")
+        return len(units)
+
+    def _write_assign(self, batch):
+        units = []
+        for chunk in _chunks(batch):
+            units += (StockUnit.query.filter(StockUnit.barcode.in_(chunk), StockUnit.status == "In Stock")
+                      .with_for_update(skip_locked=True).all())
+        ok = {u.barcode for u in units}
+        self.rejected.extend({"barcode": b, "reason": "no longer available"} for b in batch if b not in ok)
+        if not units:
+            return 0
+        now = datetime.now(timezone.utc)
+        n = sum(StockUnit.query.filter(StockUnit.id.in_(chunk), StockUnit.status == "In Stock")
+                .update({"status": "Assigned", "last_update": now}, synchronize_session=False)
+                for chunk in _chunks(u.id for u in units))
+        if n != len(units):
+            raise RuntimeError("stock changed during flush")
+        for u in units:
+            db.session.add(OrderUnit(order_id=self.order_id, unit_id=u.id))
+            record_stock_movement(u, "assign", order_id=self.order_id)
+        return len(units)
+
+    def state(self):
+        return {"session_id": self.id, "mode": self.mode, "item_id": self.item_id, "order_id": self.order_id,
+                "accepted": self.accepted, "flushed": self.flushed, "pending": len(self.pending),
+                "rejected": self.rejected[-50:], "rejected_total": len(self.rejected)}
+
+def _flush_due_scan_sessions():
+    with _scan_sessions_lock:
+        sessions = list(_scan_sessions.values())
+    for s in sessions:
+        with s.lock:
+            if s.due():
+                s.flush()
+            if not s.pending and time.time() - s.last_seen > SCAN_SESSION_IDLE.total_seconds():
+                with _scan_sessions_lock:
+                    _scan_sessions.pop(s.id, None)
+
+def _scan_flusher():
+    while True:
+        time.sleep(SCAN_FLUSH_SECONDS)
+        try:
+            with app.app_context():
+                _flush_due_scan_sessions()
+                db.session.remove()
+        except Exception as e:
+            print("scan flusher error:", e)
+
+def _flush_scan_sessions_at_exit():
+    """Write every session's pending scans before the worker goes away."""
+    with _scan_sessions_lock:
+        sessions = list(_scan_sessions.values())
+    try:
+        with app.app_context():
+            for s in sessions:
+                with s.lock:
+                    s.flush()
+            db.session.remove()
+    except Exception as e:
+        print("scan flush at exit failed:", e)
+
+_scan_flusher_started = False
+
+def _ensure_scan_flusher():
+    global _scan_flusher_started
+    with _scan_sessions_lock:
+        if not _scan_flusher_started:
+            threading.Thread(target=_scan_flusher, name="scan-flusher", daemon=True).start()
+            atexit.register(_flush_scan_sessions_at_exit)
+            _scan_flusher_started = True
+
+@app.post("/scan/sessions")
+def scan_session_start():
+    data = request.get_json(silent=True) or request.form
+    mode = data.get("mode")
+    key = {"intake": "item_id", "assign": "order_id"}.get(mode)
+    try:
+        target_id = int(data.get(key)) if key else None
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": f"{key} must be an integer"}), 400
+    if mode == "intake":
+        item = db.session.get(StockItem, target_id)
+        if item is None:
+            return jsonify({"ok": False, "error": "item not found"}), 404
+        s = ScanSession("intake", item_id=item.id, batch_number=(data.get("batch_number") or "").strip() or None)
+    elif mode == "assign":
+        order = db.session.get(Order, target_id)
+        if order is None:
+            return jsonify({"ok": False, "error": "order not found"}), 404
+        s = ScanSession("assign", order_id=order.id)
+    else:
+        return jsonify({"ok": False, "error": "mode must be intake or assign"}), 400
+    with _scan_sessions_lock:
+        _scan_sessions[s.id] = s
+    _ensure_scan_flusher()
+    return jsonify({"ok": True, **s.state()}), 201
+
+def _get_scan_session(sid):
+    with _scan_sessions_lock:
+        return _scan_sessions.get(sid)
+
+@app.post("/scan/sessions/<sid>/scan")
+def scan_session_scan(sid):
+    """{"barcode": ".."} or {"barcodes": [..]} (client-side buffered batches)."""
+    s = _get_scan_session(sid)
+    if s is None:
+        return jsonify({"ok": False, "error": "unknown or expired scan session"}), 404
+    data = request.get_json(silent=True)
+    if data is None:  # form post: barcodes=..&barcodes=..
+        barcodes = request.form.getlist("barcodes") or [request.form.get("barcode")]
+    else:
+        barcodes = data.get("barcodes") or [data.get("barcode")]
+        if not isinstance(barcodes, list):
+            return jsonify({"ok": False, "error": "barcodes must be a list"}), 400
+    with s.lock:
+        s.last_seen = time.time()
+        results = [{"barcode": b, "ok": reason is None, **({"reason": reason} if reason else {})}
+                   for b in barcodes for reason in [s.scan(b)]]
+        if len(s.pending) >= SCAN_FLUSH_SIZE:
+            s.flush()
+        state = s.state()
+    return jsonify({"ok": True, "results": results, **state})
 
+@app.get("/scan/sessions/<sid>")
+def scan_session_status(sid):
+    s = _get_scan_session(sid)
+    if s is None:
+        return jsonify({"ok": False, "error": "unknown or expired scan session"}), 404
+    with s.lock:
+        return jsonify({"ok": True, **s.state()})
 
+@app.post("/scan/sessions/<sid>/close")
+def scan_session_close(sid):
+    s = _get_scan_session(sid)
+    if s is None:
+        return jsonify({"ok": False, "error": "unknown or expired scan session"}), 404
+    with s.lock:
+        s.flush()
+        state = s.state()
+    with _scan_sessions_lock:
+        _scan_sessions.pop(sid, None)
+    return jsonify({"ok": True, "closed": True, **state})
 
 
 
@@ -994,7 +3505,225 @@ def unassign_unit(order_id, ou_id):
 
 
 
+
+
+
+
+# ---------------- Archival of completed orders ----------------
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "365"))
+
+def _year_expr(col):
+    if _is_sqlite():
+        return db.cast(func.strftime("%Y", col), db.Integer)
+    return db.cast(func.extract("year", col), db.Integer)
+
+def archive_completed_orders(days=None, batch_size=500):
+    """Move orders completed more than `days` ago, with their items, units and call logs,
+    into the *_archive tables. Set-based INSERT..SELECT + DELETE per batch; one transaction
+    per batch so writers are never blocked for long. Returns the number of orders moved.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS if days is None else days)
+    moved = 0
+    while True:
+        ids = [r[0] for r in db.session.query(Order.id)
+               .filter(Order.completed_at != None, Order.completed_at < cutoff)
+               .order_by(Order.id).limit(batch_size)]
+        if not ids:
+            return moved
+        src = Order.__table__
+        cols = [c.name for c in src.columns]
+        db.session.execute(order_archive.insert().from_select(
+            cols + ["archive_year", "archived_at"],
+            db.select(*src.c, _year_expr(src.c.completed_at), db.literal(datetime.utcnow(), db.DateTime))
+            .where(src.c.id.in_(ids))))
+        for model, archive in ((OrderItem, order_item_archive), (OrderUnit, order_unit_archive),
+                               (OrderCallLog, order_call_log_archive)):
+            t = model.__table__
+            db.session.execute(archive.insert().from_select(
+                [c.name for c in t.columns], db.select(*t.c).where(t.c.order_id.in_(ids))))
+            model.query.filter(model.order_id.in_(ids)).delete(synchronize_session=False)
+        Order.query.filter(Order.id.in_(ids)).delete(synchronize_session=False)
+        _bump_versions(db.session.connection(), ["order_archive"])
+        db.session.commit()
+        moved += len(ids)
+
+def search_orders(q, include_archived=True, limit=100):
+    """Name/surname/practitioner/provider search across hot and archived orders."""
+    like = f"%{q}%"
+    def match(t):
+        return db.or_(t.c.name.ilike(like), t.c.surname.ilike(like),
+                      t.c.practitioner_name.ilike(like), t.c.provider.ilike(like))
+    out = []
+    hot = Order.__table__
+    sources = [(hot, OrderItem.__table__, False)]
+    if include_archived:
+        sources.append((order_archive, order_item_archive, True))
+    for t, items_t, archived in sources:
+        rows = db.session.execute(db.select(t).where(match(t)).order_by(t.c.created_at.desc()).limit(limit)).mappings().all()
+        items = {}
+        if rows:
+            for it in db.session.execute(db.select(items_t).where(items_t.c.order_id.in_([r["id"] for r in rows]))).mappings():
+                items.setdefault(it["order_id"], []).append({"sku": it["sku"], "qty": it["qty"]})
+        for r in rows:
+            out.append({"id": r["id"], "provider": r["provider"], "name": r["name"], "surname": r["surname"],
+                        "practitioner_name": r["practitioner_name"], "status": r["status"],
+                        "created_at": _iso(r["created_at"]), "completed_at": _iso(r["completed_at"]),
+                        "items": items.get(r["id"], []), "archived": archived})
+    out.sort(key=lambda o: o["created_at"] or "", reverse=True)
+    return out[:limit]
+
+@app.get("/api/v1/orders/search")
+@read_replica
+def api_orders_search():
+    q = (request.args.get("q") or "").strip()
+    if len(q) < 2:
+        return jsonify({"ok": False, "error": "q must be at least 2 characters"}), 400
+    archived = request.args.get("archived", "1") not in ("0", "false", "no")
+    return jsonify({"ok": True, "data": search_orders(q, include_archived=archived)})
+
+@app.cli.command("archive-orders")
+@click.option("--days", type=int, default=None, help="Archive orders completed more than N days ago.")
+def archive_orders_command(days):
+    """Move old completed orders into the archive tables."""
+    ensure_schema()
+    n = archive_completed_orders(days)
+    click.echo(f"Archived {n} order(s).")
+
+# ---------------- JSON API (v1) ----------------
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+
+def _iso(v):
+    return v.isoformat() if v else None
+
+def _order_json(o):
+    return {
+        "id": o.id, "provider": o.provider, "name": o.name, "surname": o.surname,
+        "practitioner_name": o.practitioner_name, "status": o.status, "notes": o.notes,
+        "email_status": o.email_status, "ordered_at": _iso(o.ordered_at),
+        "created_at": _iso(o.created_at), "completed_at": _iso(o.completed_at),
+        **{f: bool(getattr(o, f)) for f in ORDER_FLAGS},
+        "items": [{"id": it.id, "sku": it.sku, "qty": it.qty} for it in o.items],
+        "version": o.row_version,
+    }
+
+def _item_json(i):
+    return {"id": i.id, "name": i.name, "sku": i.sku, "provider": i.provider,
+            "expiry_date": _iso(i.expiry_date), "received_date": _iso(i.received_date),
+            "current_stock": i.current_stock, "version": i.row_version}
+
+def _unit_json(u):
+    return {"id": u.id, "barcode": u.barcode, "batch_number": u.batch_number, "status": u.status,
+            "item_id": u.item_id, "last_update": _iso(u.last_update), "version": u.row_version}
+
+def _task_json(t):
+    return {"id": t.id, "title": t.title, "provider": t.provider, "assignee": t.assignee,
+            "due_date": _iso(t.due_date), "status": t.status, "notes": t.notes,
+            "created_at": _iso(t.created_at), "version": t.row_version}
+
+def _document_json(d):
+    return {"id": d.id, "provider": d.provider, "filename": d.filename,
+            "uploaded_at": _iso(d.uploaded_at), "version": d.row_version,
+            "url": url_for("download_uploaded", provider=d.provider, stored_name=d.stored_name)}
+
+# resource -> (model, serializer, {query arg: column})
+API_RESOURCES = {
+    "orders": (Order, _order_json, {"provider": Order.provider, "status": Order.status}),
+    "items": (StockItem, _item_json, {"provider": StockItem.provider, "sku": StockItem.sku}),
+    "units": (StockUnit, _unit_json, {"item_id": StockUnit.item_id, "status": StockUnit.status,
+                                      "barcode": StockUnit.barcode, "batch_number": StockUnit.batch_number}),
+    "tasks": (Task, _task_json, {"status": Task.status, "assignee": Task.assignee, "provider": Task.provider}),
+    "documents": (Document, _document_json, {"provider": Document.provider}),
+}
+
+def _api_error(status, msg):
+    return jsonify({"ok": False, "error": msg}), status
+
+def _encode_cursor(last_id):
+    return urlsafe_b64encode(json.dumps({"after": last_id}).encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor):
+    raw = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    return int(json.loads(raw)["after"])
+
+def _sparse(row, fields):
+    return {k: v for k, v in row.items() if k in fields} if fields else row
+
+def _api_conditional(etag, build):
+    """304 if the client already has `etag`, else the JSON body from build()."""
+    if request.if_none_match.contains_weak(etag):  # compression weakens the tag
+        resp = app.response_class(status=304)
+    else:
+        resp = jsonify(build())
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+@app.get("/api/v1/<resource>")
+@read_replica
+def api_list(resource):
+    """Keyset-paginated collection: ?limit=&cursor=&fields=a,b&<filter>=value.
+
+    The ETag fingerprints the page window (count, id range and summed row
+    versions) with one aggregate query, so unchanged pages answer 304
+    without loading or serializing any rows.
+    """
+    if resource not in API_RESOURCES:
+        return _api_error(404, f"unknown resource {resource!r}")
+    model, to_json, filters = API_RESOURCES[resource]
+    try:
+        limit = min(max(int(request.args.get("limit", API_PAGE_SIZE)), 1), API_MAX_PAGE_SIZE)
+        after = _decode_cursor(request.args["cursor"]) if request.args.get("cursor") else 0
+    except (ValueError, KeyError, TypeError):
+        return _api_error(400, "bad limit or cursor")
+    fields = {f.strip() for f in request.args.get("fields", "").split(",") if f.strip()}
+
+    q = model.query.filter(model.id > after)
+    for arg, col in filters.items():
+        if request.args.get(arg):
+            val = request.args[arg]
+            q = q.filter(col == (normalize_provider(val) if arg == "provider" else val))
+    window = q.with_entities(model.id, model.row_version).order_by(model.id).limit(limit).subquery()
+    n, lo, hi, vsum = db.session.query(
+        func.count(window.c.id), func.min(window.c.id), func.max(window.c.id),
+        func.coalesce(func.sum(window.c.row_version), 0)).one()
+    key = f"{resource}|{sorted(request.args.items(multi=True))}|{n}|{lo}|{hi}|{vsum}"
+    if model is Order:  # embedded items version independently
+        items = db.session.query(
+            func.count(OrderItem.id), func.max(OrderItem.id), func.coalesce(func.sum(OrderItem.row_version), 0)
+        ).filter(OrderItem.order_id.in_(db.select(window.c.id))).one()
+        key += "|" + "|".join(map(str, items))
+    etag = hashlib.sha1(key.encode()).hexdigest()[:20]
+
+    def build():
+        page = q.order_by(model.id).limit(limit)
+        if model is Order:
+            page = page.options(selectinload(Order.items))
+        rows = page.all()
+        return {"ok": True, "data": [_sparse(to_json(r), fields) for r in rows],
+                "next_cursor": _encode_cursor(rows[-1].id) if len(rows) == limit else None}
+    return _api_conditional(etag, build)
+
+@app.get("/api/v1/<resource>/<int:rid>")
+@read_replica
+def api_get(resource, rid):
+    if resource not in API_RESOURCES:
+        return _api_error(404, f"unknown resource {resource!r}")
+    model, to_json, _ = API_RESOURCES[resource]
+    version = db.session.query(model.row_version).filter(model.id == rid).first()
+    if version is None:
+        return _api_error(404, f"{resource[:-1]} {rid} not found")
+    tag = f"{resource}-{rid}-{version[0]}"
+    if model is Order:  # embedded items version independently
+        tag += "-" + "-".join(f"{i}.{v}" for i, v in db.session.query(OrderItem.id, OrderItem.row_version)
+                                .filter(OrderItem.order_id == rid).order_by(OrderItem.id))
+    fields = {f.strip() for f in request.args.get("fields", "").split(",") if f.strip()}
+    return _api_conditional(hashlib.sha1(tag.encode()).hexdigest()[:20],
+                            lambda: {"ok": True, "data": _sparse(to_json(db.session.get(model, rid)), fields)})
+
+
 @app.post("/api/ask_ai")
+@rate_limit("10/minute")
 def ask_ai():
     """
     Smarter intent-aware AI endpoint.
@@ -1027,10 +3756,10 @@ def ask_ai():
         return None
 
     def parse_provider(text):
-        providers = ["Geneway","Optiway","Enbiosis","Reboot","Intelligene","Healthy Me","Intelligene Fedhealth","Geko"]
-        for p in providers:
-            if p.lower() in text:
-                return p
+        # longest alias first so "intelligene fedhealth" is not read as "intelligene"
+        for key, (_, name) in sorted(_provider_index().items(), key=lambda kv: -len(kv[0])):
+            if key in text:
+                return name
         return None
 
     def parse_order_id(text):
@@ -1051,10 +3780,7 @@ def ask_ai():
     # low stock
     if "low" in prompt and "stock" in prompt:
         thr = parse_threshold(prompt, 2)
-        low = []
-        for si in db.session.query(StockItem).order_by(StockItem.current_stock.asc()).limit(100):
-            if (si.current_stock or 0) <= thr:
-                low.append({"name": si.name, "qty": si.current_stock, "provider": si.provider})
+        low = [{"name": si.name, "qty": qty, "provider": si.provider} for si, qty in low_stock_items(thr)]
         if wants_json():
             return {"ok": True, "items": low, "threshold": thr, "total": len(low)}
         return {"ok": True, "answer": ", ".join([f"{x['name']}({x['qty']})" for x in low[:20]]) or "No low-stock items found."}
@@ -1065,10 +3791,10 @@ def ask_ai():
         from datetime import date
         today = date.today()
         horizon = today + timedelta(days=days)
-        soon = []
-        for si in db.session.query(StockItem).filter(StockItem.expiry_date != None).order_by(StockItem.expiry_date.asc()).limit(200):
-            if si.expiry_date and today <= si.expiry_date <= horizon:
-                soon.append({"name": si.name, "expires": si.expiry_date.isoformat(), "provider": si.provider})
+        soon = [{"name": si.name, "expires": si.expiry_date.isoformat(), "provider": si.provider}
+                for si in db.session.query(StockItem)
+                .filter(StockItem.expiry_date >= today, StockItem.expiry_date <= horizon)
+                .order_by(StockItem.expiry_date.asc()).limit(200)]
         if wants_json():
             return {"ok": True, "items": soon, "days": days, "total": len(soon)}
         return {"ok": True, "answer": ", ".join([f"{x['name']}→{x['expires']}" for x in soon[:20]]) or f"No items expiring in {days} days."}
@@ -1084,10 +3810,7 @@ def ask_ai():
 
     # fallback to OpenRouter with context
     prov = {row[0] or "Unknown": row[1] for row in db.session.query(Order.provider, db.func.count(Order.id)).group_by(Order.provider)}
-    low = []
-    for si in db.session.query(StockItem).order_by(StockItem.current_stock.asc()).limit(20):
-        if (si.current_stock or 0) <= 2:
-            low.append({"name": si.name, "qty": si.current_stock})
+    low = [{"name": si.name, "qty": qty} for si, qty in low_stock_items(2, limit=20)]
 
     context = (
         f"Orders: total={total}, completed={completed}, pending={pending}, cancelled={cancelled}. "
@@ -1114,6 +3837,469 @@ def ask_ai():
         return {"ok": True, "answer": f"Orders total={total}, completed={completed}, pending={pending}. Low stock: " + (", ".join([f"{x['name']}({x['qty']})" for x in low]) or "none")}
 
 
+# ---------------- SLA reminders ----------------
+# A scheduler thread (SLA_REMINDERS=1) finds open orders that crossed an SLA
+# since the last run, records each breach once (unique order_id + stage),
+# groups them per practitioner and queues one Notification per group in the
+# same transaction; pending notifications then go out in one BulkMessages call.
+# A notification left in "sending" by a crash, or by a timeout after the
+# batch went out, is not retried automatically, so nothing is double-sent;
+# only failures before the request was sent are retried.
+SLA_REMINDERS = _as_bool(os.environ.get("SLA_REMINDERS"))
+SLA_CHECK_SECONDS = int(os.environ.get("SLA_CHECK_SECONDS", "300"))
+SLA_HOURS = int(os.environ.get("SLA_HOURS", "24"))  # matches time_left()
+SLA_STAGE_HOURS = json.loads(os.environ.get("SLA_STAGE_HOURS", "")
+                             or '{"sent_out": 24, "received_back": 336, "results_sent": 672}')
+SLA_LOOKBACK_DAYS = int(os.environ.get("SLA_LOOKBACK_DAYS", "90"))
+SLA_FALLBACK_PHONE = os.environ.get("SLA_FALLBACK_PHONE")  # ops number for orders without a practitioner phone
+SLA_SMS_TEST_MODE = _as_bool(os.environ.get("SLA_SMS_TEST_MODE"))
+NOTIFY_MAX_ATTEMPTS = 3
+SMS_MAX_LEN = 459  # three concatenated SMS parts
+
+def _stage_label(stage):
+    return "overdue" if stage == "overdue" else "not " + stage.replace("_", " ")
+
+def _practitioner_phones():
+    phones = {}
+    for p in PRACTITIONERS:
+        if p.get("phone"):
+            for name in (f"{p.get('name', '')} {p.get('surname', '')}", f"{p.get('first_name', '')} {p.get('last_name', '')}"):
+                if name.strip():
+                    phones[name.strip().lower()] = p["phone"]
+    return phones
+
+def find_sla_breaches(now=None):
+    """{order_id: (row, [new stages])} for open orders past an SLA that were not yet alerted.
+
+    One range scan on ix_order_open_created (completed_at IS NULL, created_at
+    window), then one lookup of already-recorded alerts for those ids.
+    """
+    now = now or datetime.utcnow()
+    youngest = now - timedelta(hours=min([SLA_HOURS, *SLA_STAGE_HOURS.values()]))
+    rows = (db.session.query(Order.id, Order.provider, Order.practitioner_name, Order.name, Order.surname,
+                             Order.created_at, *(getattr(Order, f) for f in SLA_STAGE_HOURS))
+            .filter(Order.completed_at.is_(None), Order.created_at <= youngest,
+                    Order.created_at >= now - timedelta(days=SLA_LOOKBACK_DAYS))
+            .all())
+    done = set()
+    for chunk in _chunks([r.id for r in rows]):
+        done.update(db.session.query(SlaAlert.order_id, SlaAlert.stage).filter(SlaAlert.order_id.in_(chunk)))
+    out = {}
+    for r in rows:
+        age_h = (now - r.created_at).total_seconds() / 3600
+        stages = ["overdue"] if age_h >= SLA_HOURS else []
+        stages += [f for f, h in SLA_STAGE_HOURS.items() if age_h >= h and not getattr(r, f)]
+        stages = [st for st in stages if (r.id, st) not in done]
+        if stages:
+            out[r.id] = (r, stages)
+    return out
+
+def _reminder_body(recipient, entries):
+    head = f"Life360: {len(entries)} order(s) for {recipient} need attention: "
+    parts = []
+    for i, (r, stages) in enumerate(entries):
+        part = " ".join(filter(None, [f"#{r.id}", r.name, r.surname, f"({', '.join(map(_stage_label, stages))})"]))
+        tail = f"; +{len(entries) - i} more"
+        if parts and len(head) + len("; ".join(parts + [part])) + len(tail) > SMS_MAX_LEN:
+            return head + "; ".join(parts) + tail
+        parts.append(part)
+    return head + "; ".join(parts)
+
+def queue_sla_reminders(now=None, dry_run=False):
+    """Group new breaches per practitioner (else provider) and queue one Notification each.
+
+    Returns the queued (or, with dry_run, would-be) notifications as dicts.
+    A group with no phone number is not queued and its breaches are not
+    recorded, so it is picked up again once a number is known.
+    """
+    seed_demo_if_empty()  # practitioners (and their phones) live in memory
+    phones = _practitioner_phones()
+    groups = {}
+    for r, stages in find_sla_breaches(now).values():
+        recipient = (r.practitioner_name or "").strip() or (r.provider or "Unassigned")
+        groups.setdefault(recipient, []).append((r, stages))
+    out = []
+    for recipient, entries in sorted(groups.items()):
+        entries.sort(key=lambda e: e[0].id)
+        keys = [f"{r.id}:{st}" for r, stages in entries for st in stages]
+        note = Notification(
+            idempotency_key=hashlib.sha256(f"sla|{recipient}|{','.join(keys)}".encode()).hexdigest(),
+            recipient=recipient, destination=phones.get(recipient.lower()) or SLA_FALLBACK_PHONE,
+            body=_reminder_body(recipient, entries))
+        out.append({"recipient": recipient, "destination": note.destination, "body": note.body, "alerts": keys})
+        if dry_run:
+            continue
+        if not note.destination:
+            app.logger.warning("SLA reminder for %s not queued: no phone number", recipient)
+            out.pop()
+            continue
+        try:
+            db.session.add(note)
+            db.session.flush()
+            db.session.add_all(SlaAlert(order_id=r.id, stage=st, notification_id=note.id)
+                               for r, stages in entries for st in stages)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # another worker queued these breaches first
+            out.pop()
+    return out
+
+def _request_not_sent(e):
+    """True if requests failed before the request went out (connect/DNS/TLS), so a retry cannot double-send."""
+    if isinstance(e, (requests.ConnectTimeout, requests.exceptions.SSLError)):
+        return True
+    reason = getattr(e.args[0], "reason", None) if isinstance(e, requests.ConnectionError) and e.args else None
+    return isinstance(reason, NewConnectionError)
+
+def send_pending_notifications(limit=100):
+    """Claim up to `limit` pending/failed notifications and send them in one batch. Returns counts."""
+    token = uuid.uuid4().hex
+    retryable = db.or_(Notification.status == "pending",
+                       db.and_(Notification.status == "failed", Notification.attempts < NOTIFY_MAX_ATTEMPTS))
+    ids = [i for (i,) in db.session.query(Notification.id).filter(retryable).order_by(Notification.id).limit(limit)]
+    if not ids:
+        return {"sent": 0, "failed": 0, "unknown": 0, "no_destination": 0}
+    Notification.query.filter(Notification.id.in_(ids), retryable).update(
+        {"status": "sending", "claimed_by": token, "attempts": Notification.attempts + 1},
+        synchronize_session=False)
+    db.session.commit()
+    claimed = Notification.query.filter_by(claimed_by=token, status="sending").all()
+    counts = {"sent": 0, "failed": 0, "unknown": 0, "no_destination": 0}
+    batch = []
+    phones = _practitioner_phones() if any(not n.destination for n in claimed) else {}
+    for n in claimed:
+        n.destination = n.destination or phones.get((n.recipient or "").lower()) or SLA_FALLBACK_PHONE
+        if n.destination:
+            batch.append(n)
+        else:  # stays retryable until a number is known
+            n.status, n.last_error = "pending", "no destination"
+            counts["no_destination"] += 1
+    if batch:
+        status, error = "sent", None
+        try:
+            resp = mymobileapi_send([{"destination": n.destination, "content": n.body, "customerId": n.idempotency_key[:40]}
+                                     for n in batch], test_mode=SLA_SMS_TEST_MODE)
+            if resp.status_code != 200:
+                status, error = "failed", f"HTTP {resp.status_code}"
+        except requests.RequestException as e:
+            if _request_not_sent(e):
+                status, error = "failed", type(e).__name__
+            else:  # the gateway may have accepted the batch: leave it in "sending" for a person to check
+                status, error = "sending", f"unknown outcome: {type(e).__name__}"
+        for n in batch:
+            n.status, n.last_error = status, error
+            if status == "sent":
+                n.sent_at = datetime.utcnow()
+        counts[{"sent": "sent", "failed": "failed", "sending": "unknown"}[status]] += len(batch)
+    db.session.commit()
+    return counts
+
+_notify_pending = {"count": None, "at": None}  # from the last scheduler run, for /readyz
+
+def run_sla_reminders():
+    queued = queue_sla_reminders()
+    result = {"queued": len(queued), **send_pending_notifications()}
+    _notify_pending.update(count=Notification.query.filter(Notification.status == "pending").count(),
+                           at=datetime.utcnow())
+    return result
+
+def notification_stats():
+    return dict(db.session.query(Notification.status, func.count(Notification.id)).group_by(Notification.status).all())
+
+HEALTH_QUEUES["notifications_pending"] = lambda: _notify_pending["count"]  # no query per probe
+
+def _sla_scheduler():
+    while True:
+        try:
+            with app.app_context():
+                run_sla_reminders()
+                db.session.remove()
+        except Exception as e:
+            print("sla scheduler error:", e)
+        time.sleep(SLA_CHECK_SECONDS)
+
+_sla_scheduler_started = False
+
+def _ensure_sla_scheduler():
+    global _sla_scheduler_started
+    if not _sla_scheduler_started:
+        _sla_scheduler_started = True
+        threading.Thread(target=_sla_scheduler, name="sla-reminders", daemon=True).start()
+
+@app.get("/admin/sla-reminders")
+def sla_reminders_status():
+    recent = Notification.query.order_by(Notification.id.desc()).limit(20).all()
+    return jsonify({"ok": True, "enabled": SLA_REMINDERS, "counts": notification_stats(),
+                    "recent": [{"id": n.id, "recipient": n.recipient, "status": n.status, "attempts": n.attempts,
+                                "created_at": _iso(n.created_at), "sent_at": _iso(n.sent_at),
+                                "last_error": n.last_error} for n in recent]})
+
+@app.post("/admin/sla-reminders/run")
+def sla_reminders_run():
+    return jsonify({"ok": True, **run_sla_reminders()})
+
+@app.cli.command("sla-reminders")
+@click.option("--dry-run", is_flag=True, help="Print the reminders that would be queued without writing or sending.")
+def sla_reminders_command(dry_run):
+    """Queue and send SLA reminders once."""
+    ensure_schema()
+    if dry_run:
+        for n in queue_sla_reminders(dry_run=True):
+            click.echo(f"{n['recipient']} -> {n['destination'] or '(no phone)'}: {n['body']}")
+        return
+    click.echo(json.dumps(run_sla_reminders()))
+
+# ---------------- Backups ----------------
+# SQLite: online backup API in BACKUP_PAGES_PER_STEP chunks with a pause
+# between steps (locks are only held during a step; with SQLITE_WAL writers
+# are never blocked, without it a write waits for the current step). If
+# writers keep restarting the copy it falls back to one snapshot step.
+# Postgres: pg_dump, which reads from an MVCC snapshot.
+# uploads/ goes into a content-addressed blob store, so each run only copies
+# files that changed. Every run writes manifest-<ts>.json; the newest
+# BACKUP_KEEP runs are kept and unreferenced blobs are deleted.
+BACKUP_DIR = os.environ.get("BACKUP_DIR", os.path.join(BASE_DIR, "backups"))
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "14"))
+BACKUP_PAGES_PER_STEP = int(os.environ.get("BACKUP_PAGES_PER_STEP", "1024"))
+BACKUP_STEP_SLEEP = float(os.environ.get("BACKUP_STEP_SLEEP", "0.02"))
+BACKUP_MAX_RESTARTS = 3
+BACKUP_INTERVAL_HOURS = float(os.environ.get("BACKUP_INTERVAL_HOURS", "0"))  # 0 = only via `flask backup`
+
+class _BackupRestarted(Exception):
+    pass
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _pg_command(url):
+    """(libpq URL without the password, environment with PGPASSWORD) for pg_dump/pg_restore.
+
+    The password stays out of argv, which any local user can read from the process list.
+    """
+    env = dict(os.environ)
+    if url.password is not None:
+        env["PGPASSWORD"] = str(url.password)
+    return url.set(drivername="postgresql")._replace(password=None).render_as_string(hide_password=False), env
+
+def _backup_sqlite(src_path, dst_path):
+    """Online copy of a live SQLite file; returns the number of restarts caused by concurrent writes."""
+    src, dst = sqlite3.connect(src_path, timeout=30), sqlite3.connect(dst_path)
+    try:
+        restarts = 0
+        while True:
+            last = []
+            def progress(status, remaining, total):
+                if last and remaining > last[-1]:
+                    raise _BackupRestarted()  # source changed under us; SQLite started over
+                last.append(remaining)
+                time.sleep(BACKUP_STEP_SLEEP)
+            try:
+                src.backup(dst, pages=BACKUP_PAGES_PER_STEP if restarts < BACKUP_MAX_RESTARTS else -1,
+                           progress=progress)
+                break
+            except _BackupRestarted:
+                restarts += 1
+        check = dst.execute("PRAGMA quick_check").fetchone()[0]
+        if check != "ok":
+            raise RuntimeError(f"backup copy failed quick_check: {check}")
+        return restarts
+    finally:
+        src.close(); dst.close()
+
+def _blob_path(digest):
+    return os.path.join(BACKUP_DIR, "blobs", digest[:2], digest)
+
+def _backup_uploads(previous):
+    """{relpath: {"sha256", "size", "mtime_ns"}} for uploads/, copying only new content into blobs/.
+
+    Files whose size and mtime match the previous manifest are not re-hashed.
+    """
+    index, new_blobs, new_bytes = {}, 0, 0
+    for root, _, files in os.walk(UPLOAD_ROOT):
+        for name in files:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, UPLOAD_ROOT)
+            st = os.stat(path)
+            prev = previous.get(rel)
+            if prev and prev["size"] == st.st_size and prev["mtime_ns"] == st.st_mtime_ns:
+                digest = prev["sha256"]
+            else:
+                digest = _file_sha256(path)
+            blob = _blob_path(digest)
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                shutil.copyfile(path, blob + ".tmp")
+                os.replace(blob + ".tmp", blob)
+                new_blobs += 1
+                new_bytes += st.st_size
+            index[rel] = {"sha256": digest, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    return index, new_blobs, new_bytes
+
+def list_backups():
+    """Manifests, newest first."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    out = []
+    for name in sorted(os.listdir(BACKUP_DIR), reverse=True):
+        if name.startswith("manifest-") and name.endswith(".json"):
+            with open(os.path.join(BACKUP_DIR, name)) as f:
+                out.append({"manifest": name, **json.load(f)})
+    return out
+
+def rotate_backups(keep=BACKUP_KEEP):
+    """Delete runs beyond the newest `keep` and blobs no kept run references. Returns runs removed."""
+    runs = list_backups()
+    for old in runs[keep:]:
+        for name in (old["manifest"], old["database"]["file"]):
+            try:
+                os.remove(os.path.join(BACKUP_DIR, name))
+            except FileNotFoundError:
+                pass
+    live = {meta["sha256"] for run in runs[:keep] for meta in run["uploads"].values()}
+    blob_root = os.path.join(BACKUP_DIR, "blobs")
+    for root, _, files in os.walk(blob_root):
+        for name in files:
+            if name not in live:
+                os.remove(os.path.join(root, name))
+    return max(0, len(runs) - keep)
+
+def run_backup():
+    """One backup run; returns its manifest, or None if another process holds the backup lock."""
+    with file_lock(os.path.join(BACKUP_DIR, ".lock"), blocking=False) as locked:
+        if not locked:
+            return None
+        ts = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+        url = db.engine.url
+        t0 = time.perf_counter()
+        if url.get_backend_name() == "sqlite":
+            out = f"db-{ts}.sqlite.gz"
+            tmp = os.path.join(BACKUP_DIR, f".db-{ts}.sqlite")
+            try:
+                restarts = _backup_sqlite(url.database, tmp)
+                with open(tmp, "rb") as src, gzip.open(os.path.join(BACKUP_DIR, out) + ".tmp", "wb", compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            os.replace(os.path.join(BACKUP_DIR, out) + ".tmp", os.path.join(BACKUP_DIR, out))
+        elif url.get_backend_name() == "postgresql":
+            out, restarts = f"db-{ts}.dump", 0
+            pg_url, env = _pg_command(url)
+            subprocess.run(["pg_dump", "--format=custom", "--compress=6", "--no-owner",
+                            "--file", os.path.join(BACKUP_DIR, out), pg_url], check=True, env=env)
+        else:
+            raise RuntimeError(f"no backup method for {url.get_backend_name()}")
+        db_path = os.path.join(BACKUP_DIR, out)
+        database = {"file": out, "backend": url.get_backend_name(), "sha256": _file_sha256(db_path),
+                    "bytes": os.path.getsize(db_path), "seconds": round(time.perf_counter() - t0, 2),
+                    "restarts": restarts}
+        previous = list_backups()
+        uploads, new_blobs, new_bytes = _backup_uploads(previous[0]["uploads"] if previous else {})
+        manifest = {"created_at": ts, "database": database, "uploads": uploads,
+                    "uploads_new_blobs": new_blobs, "uploads_new_bytes": new_bytes}
+        path = os.path.join(BACKUP_DIR, f"manifest-{ts}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+        rotate_backups()
+        return manifest
+
+def restore_backup(manifest_name, uploads=True):
+    """Restore the database (online, in one transaction) and missing/changed upload files."""
+    with open(os.path.join(BACKUP_DIR, manifest_name)) as f:
+        manifest = json.load(f)
+    src = os.path.join(BACKUP_DIR, manifest["database"]["file"])
+    if _file_sha256(src) != manifest["database"]["sha256"]:
+        raise RuntimeError(f"{src} does not match its manifest checksum")
+    before = dict(db.session.query(DataVersion.name, DataVersion.version))
+    db.session.remove()
+    db.engine.dispose()
+    url = db.engine.url
+    if url.get_backend_name() == "sqlite":
+        tmp = os.path.join(BACKUP_DIR, ".restore.sqlite")
+        try:
+            with gzip.open(src, "rb") as fin, open(tmp, "wb") as fout:
+                shutil.copyfileobj(fin, fout, 1024 * 1024)
+            restored, live = sqlite3.connect(tmp), sqlite3.connect(url.database, timeout=30)
+            try:
+                if restored.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+                    raise RuntimeError("backup file failed quick_check")
+                restored.backup(live)
+            finally:
+                restored.close(); live.close()
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    else:
+        pg_url, env = _pg_command(url)
+        subprocess.run(["pg_restore", "--clean", "--if-exists", "--no-owner", "--dbname", pg_url, src],
+                       check=True, env=env)
+    # Move every data version past anything caches have seen, so no pre-restore fragment is served.
+    for name, version in before.items():
+        DataVersion.query.filter_by(name=name).update({"version": version + 1})
+    db.session.commit()
+    copied = 0
+    if uploads:
+        for rel, meta in manifest["uploads"].items():
+            target = os.path.join(UPLOAD_ROOT, rel)
+            if os.path.exists(target) and os.path.getsize(target) == meta["size"] and _file_sha256(target) == meta["sha256"]:
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(_blob_path(meta["sha256"]), target)
+            copied += 1
+    return {"database": manifest["database"]["file"], "uploads_restored": copied}
+
+def _backup_scheduler():
+    while True:
+        try:
+            runs = list_backups()
+            newest = datetime.strptime(runs[0]["created_at"], "%Y%m%dT%H%M%SZ") if runs else None
+            if newest is None or datetime.utcnow() - newest >= timedelta(hours=BACKUP_INTERVAL_HOURS * 0.9):
+                with app.app_context():
+                    run_backup()
+        except Exception as e:
+            print("backup error:", e)
+        time.sleep(min(3600, BACKUP_INTERVAL_HOURS * 3600 / 4))
+
+_backup_scheduler_started = False
+
+def _ensure_backup_scheduler():
+    global _backup_scheduler_started
+    if not _backup_scheduler_started:
+        _backup_scheduler_started = True
+        threading.Thread(target=_backup_scheduler, name="backups", daemon=True).start()
+
+@app.cli.command("backup")
+def backup_command():
+    """Back up the database and uploads/ into BACKUP_DIR."""
+    m = run_backup()
+    if m is None:
+        raise click.ClickException("Another backup is running.")
+    d = m["database"]
+    click.echo(f"{d['file']}: {d['bytes']} bytes in {d['seconds']}s ({d['restarts']} restart(s)); "
+               f"uploads: {len(m['uploads'])} file(s), {m['uploads_new_blobs']} new ({m['uploads_new_bytes']} bytes)")
+
+@app.cli.command("backups")
+def backups_command():
+    """List backup runs, newest first."""
+    for m in list_backups():
+        click.echo(f"{m['manifest']}  {m['database']['file']}  {m['database']['bytes']} bytes  "
+                   f"{len(m['uploads'])} upload(s)")
+
+@app.cli.command("restore-backup")
+@click.argument("manifest")
+@click.option("--no-uploads", is_flag=True, help="Restore the database only.")
+@click.option("--yes", is_flag=True, help="Do not ask for confirmation.")
+def restore_backup_command(manifest, no_uploads, yes):
+    """Restore a backup run (see `flask backups`). Restart app workers afterwards."""
+    if not yes:
+        click.confirm(f"Replace the live database with {manifest}?", abort=True)
+    click.echo(json.dumps(restore_backup(manifest, uploads=not no_uploads)))
+
 if __name__ == "__main__":
     import logging, sys, os, traceback
     from datetime import timezone, datetime
@@ -1127,7 +4313,7 @@ if __name__ == "__main__":
     try:
         with app.app_context():
             # Ensure DB schema exists
-            db.create_all()
+            ensure_schema()
             if 'apply_provider_renames_db' in globals():
                 apply_provider_renames_db()
             if 'seed_demo_if_empty' in globals():
@@ -1141,7 +4327,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     try:
-        logging.info("Health check: /healthz")
+        logging.info("Health checks: /healthz (liveness), /readyz (readiness)")
         # Not actually calling HTTP, just log that it's available
         logging.info("Visit http://localhost:%s/healthz", port)
         logging.info("Open the dashboard at http://localhost:%s/", port)
@@ -0,0 +1,235 @@
+"""Concurrent load generator that replays clinic staff workflows against a running app.
+
+Roles (each a thread with its own HTTP session and think time):
+  scanner  - receives new units (add_unit_one) and scans them onto orders (assign_unit)
+  updater  - edits orders (update_order), as the order desk does
+  viewer   - opens /orders and polls the JSON API
+
+Examples:
+  python loadtest.py --start --duration 60 --scanners 4 --updaters 2 --viewers 4
+  python loadtest.py --url http://127.0.0.1:5000 --duration 30 --think 0 --json out.json
+
+--start boots `python app.py` on a throwaway copy of the database (DATABASE_URL
+is honoured, default sqlite in a temp dir) and stops it afterwards. Report:
+throughput, latency percentiles per route, HTTP errors and SQLite lock errors
+(503 "database busy" responses).
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)  # route -> [seconds]
+        self.statuses = defaultdict(lambda: defaultdict(int))  # route -> {status: n}
+        self.lock_errors = defaultdict(int)
+        self.conn_errors = defaultdict(int)
+
+    def record(self, route, status, seconds, locked=False):
+        with self.lock:
+            self.samples[route].append(seconds)
+            self.statuses[route][status] += 1
+            if locked:
+                self.lock_errors[route] += 1
+
+    def failed(self, route):
+        with self.lock:
+            self.conn_errors[route] += 1
+
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(len(sorted_samples) - 1, int(p / 100 * len(sorted_samples)))]
+
+
+class Worker(threading.Thread):
+    def __init__(self, role, base_url, rec, deadline, think, ctx, seed):
+        super().__init__(name=f"{role}-{seed}", daemon=True)
+        self.role, self.base_url, self.rec, self.deadline, self.think = role, base_url, rec, deadline, think
+        self.ctx = ctx
+        self.rand = random.Random(seed)
+        self.http = requests.Session()
+        self.in_stock = []  # barcodes this scanner received but has not assigned yet
+
+    def call(self, route, method, path, **kw):
+        t0 = time.perf_counter()
+        try:
+            resp = self.http.request(method, self.base_url + path, allow_redirects=False, timeout=30, **kw)
+        except requests.RequestException:
+            self.rec.failed(route)
+            return None
+        locked = resp.status_code == 503 and "busy" in resp.text
+        self.rec.record(route, resp.status_code, time.perf_counter() - t0, locked)
+        return resp
+
+    def pause(self):
+        if self.think > 0:
+            time.sleep(min(self.rand.expovariate(1 / self.think), self.think * 5))
+
+    def run(self):
+        step = getattr(self, f"step_{self.role}")
+        while time.time() < self.deadline:
+            step()
+            self.pause()
+
+    def step_scanner(self):
+        # mostly receiving at the start of a shift, mostly assigning once stock is there
+        if not self.in_stock or self.rand.random() < 0.4:
+            barcode = f"LT-{uuid.uuid4().hex[:12]}"
+            resp = self.call("add_unit_one", "POST", f"/item/{self.ctx['item_id']}/units/add_one",
+                             data={"barcode": barcode, "batch_number": "LOAD"})
+            if resp is not None and resp.status_code in (200, 302):
+                self.in_stock.append(barcode)
+        else:
+            barcode = self.in_stock.pop()
+            order_id = self.rand.choice(self.ctx["order_ids"])
+            self.call("assign_unit", "POST", f"/orders/{order_id}/assign", data={"barcode": barcode})
+
+    def step_updater(self):
+        order_id = self.rand.choice(self.ctx["order_ids"])
+        form = {"status": self.rand.choice(["Pending", "In Progress", "Awaiting results"]),
+                "notes": f"load test {uuid.uuid4().hex[:6]}"}
+        for flag in ("sent_out", "received_back", "kit_registered", "paid"):
+            if self.rand.random() < 0.5:
+                form[flag] = "on"
+        self.call("update_order", "POST", f"/orders/{order_id}/update", data=form)
+
+    def step_viewer(self):
+        if self.rand.random() < 0.6:
+            self.call("orders_page", "GET", "/orders")
+        else:
+            self.call("api_orders", "GET", "/api/v1/orders?limit=50&fields=id,status,provider")
+
+
+def prepare(base_url, n_orders):
+    """Find (or create) a stock item and some orders to work against."""
+    http = requests.Session()
+    items = http.get(base_url + "/api/v1/items?limit=1&fields=id", timeout=30).json()["data"]
+    if not items:
+        http.post(base_url + "/items", data={"name": "Load test kit", "sku": "LOAD-KIT"},
+                  allow_redirects=False, timeout=30)
+        items = http.get(base_url + "/api/v1/items?limit=1&fields=id", timeout=30).json()["data"]
+    orders = http.get(base_url + "/api/v1/orders?limit=500&fields=id", timeout=30).json()["data"]
+    if len(orders) < n_orders:
+        rows = [{"provider": "Geneway", "name": "Load", "surname": f"Test {i}", "items": [{"sku": "LOAD-KIT", "qty": 1}]}
+                for i in range(n_orders - len(orders))]
+        http.post(base_url + "/orders/import", json={"orders": rows}, timeout=60)
+        orders = http.get(base_url + "/api/v1/orders?limit=500&fields=id", timeout=30).json()["data"]
+    return {"item_id": items[0]["id"], "order_ids": [o["id"] for o in orders]}
+
+
+def start_server(port):
+    env = dict(os.environ, PORT=str(port))
+    env.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp(prefix='loadtest-')}/load.db")
+    proc = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "app.py")], env=env, cwd=BASE_DIR,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            if requests.get(url + "/healthz", timeout=1).ok:
+                return proc, url
+        except requests.RequestException:
+            pass
+        if proc.poll() is not None:
+            break
+        time.sleep(0.2)
+    stop_server(proc)
+    raise SystemExit("server did not come up on " + url)
+
+
+def stop_server(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)  # the debug reloader runs the app in a child process
+        proc.wait(timeout=10)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        pass
+
+
+def report(rec, elapsed):
+    routes = {}
+    total = 0
+    for route, samples in sorted(rec.samples.items()):
+        s = sorted(samples)
+        total += len(s)
+        ms = lambda v: round(v * 1000, 1) if v is not None else None
+        routes[route] = {
+            "requests": len(s), "rps": round(len(s) / elapsed, 1),
+            "p50_ms": ms(percentile(s, 50)), "p95_ms": ms(percentile(s, 95)),
+            "p99_ms": ms(percentile(s, 99)), "max_ms": ms(s[-1]),
+            "statuses": dict(rec.statuses[route]),
+            "lock_errors": rec.lock_errors[route], "connection_errors": rec.conn_errors[route],
+        }
+    return {"elapsed_s": round(elapsed, 1), "requests": total, "rps": round(total / elapsed, 1),
+            "lock_errors": sum(rec.lock_errors.values()),
+            "server_errors": sum(n for st in rec.statuses.values() for code, n in st.items() if code >= 500),
+            "routes": routes}
+
+
+def print_report(r):
+    print(f"\n{r['requests']} requests in {r['elapsed_s']}s = {r['rps']} req/s; "
+          f"lock errors: {r['lock_errors']}, 5xx: {r['server_errors']}")
+    print(f"{'route':<14}{'n':>7}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'locks':>7}  statuses")
+    for route, v in r["routes"].items():
+        print(f"{route:<14}{v['requests']:>7}{v['rps']:>8}{v['p50_ms']:>9}{v['p95_ms']:>9}{v['p99_ms']:>9}"
+              f"{v['max_ms']:>9}{v['lock_errors']:>7}  {v['statuses']}")
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--url", default="http://127.0.0.1:5000")
+    p.add_argument("--start", action="store_true", help="start app.py locally for the run")
+    p.add_argument("--port", type=int, default=5055, help="port for --start")
+    p.add_argument("--duration", type=float, default=30, help="seconds")
+    p.add_argument("--scanners", type=int, default=4)
+    p.add_argument("--updaters", type=int, default=2)
+    p.add_argument("--viewers", type=int, default=4)
+    p.add_argument("--think", type=float, default=0.5, help="mean think time between actions, seconds")
+    p.add_argument("--orders", type=int, default=50, help="make sure at least this many orders exist")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="also write the report to this file")
+    args = p.parse_args()
+
+    proc = None
+    base_url = args.url.rstrip("/")
+    if args.start:
+        proc, base_url = start_server(args.port)
+    try:
+        ctx = prepare(base_url, args.orders)
+        rec = Recorder()
+        deadline = time.time() + args.duration
+        workers = [Worker(role, base_url, rec, deadline, args.think, ctx, args.seed * 1000 + i)
+                   for role, n in (("scanner", args.scanners), ("updater", args.updaters), ("viewer", args.viewers))
+                   for i in range(n)]
+        t0 = time.perf_counter()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        r = report(rec, time.perf_counter() - t0)
+    finally:
+        if proc:
+            stop_server(proc)
+    print_report(r)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(r, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
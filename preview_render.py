@@ -0,0 +1,41 @@
+"""Thumbnail rendering for document previews.
+
+Runs in the preview worker processes. These are started with "spawn", so
+each worker imports this module (plus Pillow / PyMuPDF when a file needs
+them) rather than app.py. Under `python app.py` spawn still re-imports the
+main script, which is guarded by `if __name__ == "__main__"`.
+"""
+import os
+import subprocess
+
+
+def render_preview(src, dst, size):
+    """Write a JPEG thumbnail of `src` (image, or first page of a PDF) to `dst`; returns its size."""
+    from PIL import Image
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    if src.lower().endswith(".pdf"):
+        try:
+            import fitz
+        except ImportError:
+            fitz = None
+        if fitz is not None:
+            with fitz.open(src) as pdf:
+                page = pdf[0]
+                zoom = size / max(page.rect.width, page.rect.height)
+                page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)).save(tmp + ".png")
+        else:
+            subprocess.run(["pdftoppm", "-png", "-f", "1", "-l", "1", "-singlefile",
+                            "-scale-to", str(size), src, tmp], check=True, timeout=60)
+        src = tmp + ".png"
+    try:
+        with Image.open(src) as im:
+            im.draft("RGB", (size, size))  # JPEG: decode at reduced scale
+            im = im.convert("RGB")
+            im.thumbnail((size, size))
+            im.save(tmp, "JPEG", quality=80, optimize=True)
+        os.replace(tmp, dst)
+        return os.path.getsize(dst)
+    finally:
+        for leftover in (tmp, tmp + ".png"):
+            if os.path.exists(leftover):
+                os.remove(leftover)